@@ -0,0 +1,64 @@
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+from difflib import SequenceMatcher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sentiment_scraper"))
+
+from sentiment_scraper.extract import MIN_FAST_TEXT_CHARS, extract_text, fast_extract_text, newspaper_extract_text
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "articles")
+
+
+def load_corpus(path):
+    """
+    Loads the saved pages of the corpus. Each file starts with a `<!-- url: ... -->` comment naming the page's URL.
+    """
+    corpus = []
+    for file in sorted(glob.glob(os.path.join(path, "*.html"))):
+        with open(file, encoding="utf-8") as f:
+            html = f.read()
+        match = re.match(r"\s*<!--\s*url:\s*(\S+)\s*-->", html)
+        url = match.group(1) if match else f"https://{os.path.basename(file)}"
+        corpus.append((os.path.basename(file), url, html))
+    return corpus
+
+
+def time_extractor(extractor, corpus, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for _, url, html in corpus:
+            extractor(url, html)
+    return (time.perf_counter() - start) / (rounds * len(corpus))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the lxml fast path against newspaper3k on saved article pages")
+    parser.add_argument("--corpus", default=FIXTURES_PATH, help="Directory of saved .html pages")
+    parser.add_argument("--rounds", type=int, default=20, help="Times the corpus is extracted for the timings")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        print(f"No .html pages found in {args.corpus}")
+        sys.exit(1)
+
+    print(f"{'page':<28} {'fast chars':>10} {'newspaper chars':>15} {'similarity':>10}  path")
+    for name, url, html in corpus:
+        fast = fast_extract_text(url, html)
+        reference = newspaper_extract_text(url, html)
+        similarity = SequenceMatcher(None, fast.split(), reference.split()).ratio()
+        path = "fast" if len(fast) >= MIN_FAST_TEXT_CHARS else "fallback"
+        print(f"{name:<28} {len(fast):>10} {len(reference):>15} {similarity:>10.2f}  {path}")
+
+    newspaper_time = time_extractor(newspaper_extract_text, corpus, args.rounds)
+    combined_time = time_extractor(extract_text, corpus, args.rounds)
+    print(f"\nnewspaper3k:           {1 / newspaper_time:8.1f} pages/s")
+    print(f"fast path + fallback:  {1 / combined_time:8.1f} pages/s ({newspaper_time / combined_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_quote_server import start_server
+from fetch_engine import fetch_concurrently
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks serial vs. concurrent fundamentals fetching against a local fake quote server")
+    parser.add_argument("--tickers", type=int, default=100, help="Number of fake tickers to fetch")
+    parser.add_argument("--latency", type=float, default=0.25, help="Base response latency in seconds")
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=50.0, help="Token bucket rate, in requests per second")
+    args = parser.parse_args()
+
+    server = start_server(latency=args.latency)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/quote/"
+    tickers = [f"T{i:04d}" for i in range(args.tickers)]
+
+    def fetch_info(ticker):
+        with urllib.request.urlopen(base_url + ticker) as response:
+            return json.load(response)
+
+    start = time.perf_counter()
+    for ticker in tickers:
+        fetch_info(ticker)
+    serial = time.perf_counter() - start
+    print(f"Serial:     {serial:.2f}s ({len(tickers) / serial:.1f} tickers/s)")
+
+    start = time.perf_counter()
+    results = list(fetch_concurrently(
+        tickers,
+        fetch_info,
+        max_in_flight=args.max_in_flight,
+        rate_per_second=args.rate,
+        progress=lambda line: None,
+    ))
+    concurrent = time.perf_counter() - start
+    errors = sum(1 for _, _, error in results if error is not None)
+    print(f"Concurrent: {concurrent:.2f}s ({len(tickers) / concurrent:.1f} tickers/s, {errors} errors)")
+    print(f"Speedup:    {serial / concurrent:.1f}x")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_info(ticker):
+    """
+    Builds a deterministic, yfinance-like `.info` blob for the ticker
+    """
+    rng = random.Random(ticker)
+    return {
+        "symbol": ticker,
+        "earningsGrowth": round(rng.uniform(-0.2, 0.6), 3),
+        "dividendYield": round(rng.uniform(0, 0.03), 4),
+        "trailingEps": round(rng.uniform(-2, 12), 2),
+        "forwardEps": round(rng.uniform(-1, 14), 2),
+        "forwardPE": round(rng.uniform(5, 60), 2),
+        "trailingPE": round(rng.uniform(5, 80), 2),
+        "beta": round(rng.uniform(0.5, 2.0), 2),
+        "currentPrice": round(rng.uniform(5, 500), 2),
+        "earningsTimestamp": int(time.time()) - rng.randint(0, 90) * 86400,
+    }
+
+
+def make_handler(latency, jitter):
+    class QuoteHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # Serves /quote/<ticker> after a simulated network latency
+            parts = self.path.strip("/").split("/")
+            if len(parts) != 2 or parts[0] != "quote":
+                self.send_error(404)
+                return
+
+            time.sleep(latency + random.uniform(0, jitter))
+            body = json.dumps(fake_info(parts[1])).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return QuoteHandler
+
+
+def start_server(port=0, latency=0.25, jitter=0.1):
+    """
+    Starts the fake quote server on a background thread and returns it. `server.server_address` holds the bound port.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(latency, jitter))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake quote server for benchmarking the fundamentals fetcher")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.25, help="Base response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Random extra latency in seconds")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args.latency, args.jitter))
+    print(f"Serving fake quotes on http://127.0.0.1:{args.port}/quote/<ticker>")
+    server.serve_forever()
@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import io
 import os
 import sqlite3
 import subprocess
@@ -14,19 +15,11 @@ from create_dataframe_image import dataframe_to_image
 from discord import TextChannel
 from discord.ext import commands
 from dotenv import dotenv_values, get_key, load_dotenv, set_key
+from executors import run_cpu, run_io
 from full_workflow import progress_generator
+from jobs import SingleFlight
 from paper_trading import get_current_stocks_profit_loss
-from top_stock import pick_top_Stock
-
-# Make sure this is the only instance running if attempted to run manually
-if len(sys.argv) == 2 and sys.argv[1] == "-s":
-    print("Running with systemd")
-else:
-    result = subprocess.run(["systemctl", "is-active", "bot"], stdout=subprocess.PIPE)
-    is_running_already = result.stdout == b"active\n"
-    if is_running_already:
-        print("Bot is already running in systemd. Please stop it first!")
-        exit(1)
+from top_stock import run_ranking, stored_top_stocks
 
 # Load environment variables
 load_dotenv()
@@ -45,12 +38,79 @@ bot = commands.Bot(command_prefix="!", intents=intents)
 GUILD_ID = os.getenv("DISCORD_GUILD_ID")
 BOT_CHANNEL_ID = os.getenv("DISCORD_BOT_CHANNEL")
 
-# Used to prohibit simulatenous calls to get_top_stocks_now since the process can take ~ 10 minutes
-full_workflow_running = False
+# Coordinates the jobs of all commands, so that identical requests in flight share one job (and its result).
+# The full workflow can take ~ 10 minutes, so a second /get_top_stocks_now follows the one already running.
+# Its jobs are keyed by (FULL_WORKFLOW, force), see `join_full_workflow`.
+jobs = SingleFlight()
+FULL_WORKFLOW = "full_workflow"
 
 # Used for async events
 bot_loop = None
 
+TIMED_OUT_MESSAGE = ":hourglass: This took too long, please try again later."
+
+
+async def top_stocks_image(n=None, fresh=False):
+    """
+    Renders the top `n` stocks (TOP_N_STOCKS by default) as a table image. They are read from the latest stored
+    ranking, or with `fresh` (or if none is stored yet), ranked now and stored as a new run, in the executors' process
+    pool.
+    """
+    n = n or int(os.getenv("TOP_N_STOCKS"))
+    top_stocks = None if fresh else await run_io(stored_top_stocks, n)
+    if top_stocks is None:
+        # Scoring (and training, if there is no model for the data yet) is CPU-bound, so it never runs on an I/O thread
+        top_stocks = await run_cpu(run_ranking, n)
+    return await run_cpu(dataframe_to_image, top_stocks, "", money_cols=["current_price"])
+
+
+async def full_workflow_job(job, force):
+    """
+    Runs the full workflow, then ranks the stocks on the fresh data. Returns the rendered table as bytes, since every
+    attached caller sends its own copy.
+    """
+    async for progress in progress_generator(force=force):
+        job.status = f"{progress}"
+    job.status = "Ranking the stocks..."
+    return (await top_stocks_image(fresh=True)).getvalue()
+
+
+def join_full_workflow(force):
+    """
+    Returns the full workflow job serving a request, along with whether it was started for it. A forced run serves
+    every request, while a forced request never follows a run that isn't: it starts its own, which the pipeline runs
+    once the other one is done.
+    """
+    if not force and workflow_running(force=True):
+        return jobs.join((FULL_WORKFLOW, True), lambda job: full_workflow_job(job, True))
+    return jobs.join((FULL_WORKFLOW, force), lambda job: full_workflow_job(job, force))
+
+
+def workflow_running(force=None):
+    """
+    Returns whether the full workflow is running, with `force` or either way
+    """
+    return any(jobs.running((FULL_WORKFLOW, forced)) for forced in (False, True) if force in (None, forced))
+
+
+async def top_stocks_job(job, n):
+    """
+    Renders the top `n` stocks of the latest ranking as bytes. If the full workflow is running, its fresh ranking is
+    waited for (the stored one is used if the workflow fails).
+    """
+    if workflow_running():
+        job.status = "Waiting for the running workflow to finish..."
+        for forced in (False, True):
+            await jobs.settled((FULL_WORKFLOW, forced))
+    job.status = "Loading the latest ranking..."
+    return (await top_stocks_image(n)).getvalue()
+
+
+def join_top_stocks(n=None):
+    n = n or int(os.getenv("TOP_N_STOCKS"))
+    job, _ = jobs.join(("top_stocks", n), lambda job: top_stocks_job(job, n))
+    return job
+
 
 @bot.event
 async def on_ready():
@@ -107,19 +167,24 @@ async def clear(interaction: discord.Interaction):
     description="Gets the top stocks today from the overnight job (much faster)",
     guild=discord.Object(id=GUILD_ID),
 )
-async def get_top_stocks_today(interaction: discord.Interaction):
+async def get_top_stocks_today(interaction: discord.Interaction, n: Optional[int]):
     """
-    Gets the top stocks for the day, using the pre-calculated data from the overnight job
+    Gets the top `n` stocks for the day, from the ranking stored by the overnight job
     """
     # Show the user that they need a wait a bit
     await interaction.response.defer()
 
-    msg = "Running Model... [1/1]"
+    if workflow_running():
+        msg = "Waiting for the running workflow to finish... [1/1]"
+    else:
+        msg = "Loading the latest ranking... [1/1]"
     await interaction.edit_original_response(content=msg)
 
-    top_stocks = pick_top_Stock()
-
-    img_buf = dataframe_to_image(top_stocks, "", money_cols=["current_price"])
+    try:
+        img_buf = io.BytesIO(await join_top_stocks(n).result())
+    except asyncio.TimeoutError:
+        await interaction.edit_original_response(content=TIMED_OUT_MESSAGE)
+        return
 
     # Create and send the embed
     file = discord.File(img_buf, filename="get_top_stocks_today.png")
@@ -137,22 +202,26 @@ async def get_top_stocks_today(interaction: discord.Interaction):
     description="Gets the top stocks as of right now, running everything (takes a while!)",
     guild=discord.Object(id=GUILD_ID),
 )
-async def get_top_stocks_now(interaction: discord.Interaction):
+async def get_top_stocks_now(interaction: discord.Interaction, force: Optional[bool]):
     """
-    Gets the top stocks for the day, running the full workflow
+    Gets the top stocks for the day, running the full workflow. Steps whose inputs haven't changed since their last
+    run are skipped, unless `force` is set.
     """
-    global full_workflow_running
-    if full_workflow_running:
-        await interaction.response.send_message(
-            ":no_entry_sign: Process already running!"
-        )
-        return
-
     await interaction.response.defer()
-    full_workflow_running = True
+
+    # A workflow that is already running is followed instead of starting another one (its data is as fresh), unless
+    # this one is forced and the running one isn't
+    force = bool(force)
+    queued = force and workflow_running(force=False)
+    job, started = join_full_workflow(force)
 
     # Initialize message and spinner
-    msg = "Running full sequence now..."
+    if not started:
+        msg = "Already running, following along..."
+    elif queued:
+        msg = "Waiting for the running workflow to finish, then running every step..."
+    else:
+        msg = "Running full sequence now..."
     spinner = ["|", "/", "-", "\\\\"]
     spinner_index = 0
 
@@ -161,32 +230,37 @@ async def get_top_stocks_now(interaction: discord.Interaction):
 
     # Create a task to continuously update the spinner
     async def update_spinner():
-        nonlocal msg, spinner_index
+        nonlocal spinner_index
         while True:
             # Rotate the spinner
             spinner_index = (spinner_index + 1) % len(spinner)
             spinner_char = spinner[spinner_index]
             await interaction.edit_original_response(
-                content=f"**{spinner_char}** {msg}"
+                content=f"**{spinner_char}** {job.status or msg}"
             )
             await asyncio.sleep(0.2)  # Adjust spinner speed as needed
 
     spinner_task = asyncio.create_task(update_spinner())
 
+    # The job follows the workflow's progress and then ranks the stocks on the fresh data, which also becomes the
+    # latest stored ranking. The coordinator forgets it however it ends, so a failure never blocks the next run.
+    error = None
     try:
-        # Process the progress generator
-        async for progress in progress_generator():
-            # Append progress to the message
-            msg = f"{progress}"
+        result = await job.result()
+    except Exception as e:
+        error = e
     finally:
         # Stop the spinner when progress is complete
         spinner_task.cancel()
         await asyncio.sleep(0.1)  # Allow time for task cleanup
 
-    # Fetch top stocks
-    top_stocks = pick_top_Stock()
-
-    img_buf = dataframe_to_image(top_stocks, "", money_cols=["current_price"])
+    if isinstance(error, asyncio.TimeoutError):
+        await interaction.edit_original_response(content=TIMED_OUT_MESSAGE)
+        return
+    if error is not None:
+        await interaction.edit_original_response(content=f":x: The workflow failed: {error}")
+        return
+    img_buf = io.BytesIO(result)
 
     # Create and send the embed
     file = discord.File(img_buf, filename="get_top_stocks_now.png")
@@ -196,7 +270,6 @@ async def get_top_stocks_now(interaction: discord.Interaction):
         color=discord.Color.dark_purple(),
     )
     embed.set_image(url="attachment://get_top_stocks_now.png")
-    full_workflow_running = False
     await interaction.edit_original_response(embed=embed, attachments=[file])
 
 
@@ -292,7 +365,11 @@ async def get_paper_portfolio(interaction: discord.Interaction, tickers: Optiona
     await interaction.response.defer()
     tickers = tickers.split(",") if tickers is not None else ""
     list_specific_only = tickers != "" and len(tickers) > 0
-    df = get_current_stocks_profit_loss(tickers)
+    try:
+        df = await run_io(get_current_stocks_profit_loss, tickers)
+    except asyncio.TimeoutError:
+        await interaction.edit_original_response(content=TIMED_OUT_MESSAGE)
+        return
 
     if list_specific_only:
         df = df[
@@ -309,9 +386,13 @@ async def get_paper_portfolio(interaction: discord.Interaction, tickers: Optiona
         df = df[["stock_symbol", "current_price", "total_gain_loss"]]
 
     # Generate the image
-    img_buf = dataframe_to_image(
-        df, "total_gain_loss", money_cols=["current_price", "total_gain_loss"]
-    )
+    try:
+        img_buf = await run_cpu(
+            dataframe_to_image, df, "total_gain_loss", money_cols=["current_price", "total_gain_loss"]
+        )
+    except asyncio.TimeoutError:
+        await interaction.edit_original_response(content=TIMED_OUT_MESSAGE)
+        return
 
     # Add summary stats
     gain_loss_sum = df["total_gain_loss"].sum()
@@ -339,9 +420,7 @@ async def send_nightly_embed(bot_channel: TextChannel):
     """
     today_str = datetime.datetime.now().strftime("%x")
     top_n = os.getenv("TOP_N_STOCKS")
-    top_stocks = pick_top_Stock()
-
-    img_buf = dataframe_to_image(top_stocks, "", money_cols=["current_price"])
+    img_buf = io.BytesIO(await join_top_stocks(int(top_n)).result())
 
     # Create and send the embed
     file = discord.File(img_buf, filename="send_nightly_embed.png")
@@ -354,25 +433,44 @@ async def send_nightly_embed(bot_channel: TextChannel):
     await bot_channel.send(embed=embed, file=file)
 
 
-async def send_paper_buy_embed(bot_channel: TextChannel):
+def load_paper_buys():
     """
-    Sends the paper buy embed with the stocks that were just purchased, as activated by the paper buy cron job every Monday
+    Loads the stocks that were just purchased
     """
-    # SELECT stock_symbol, quantity, price FROM paper_trades
     db_path = os.getenv("DB_PATH")
     conn = sqlite3.connect(db_path)
+    try:
+        return pd.read_sql_query("SELECT stock_symbol, quantity, price FROM paper_trades", conn)
+    finally:
+        conn.close()
 
-    # Load tech_stocks that have valuation data
-    df_stocks = pd.read_sql_query(
-        "SELECT stock_symbol, quantity, price FROM paper_trades", conn
-    )
+
+def load_paper_sells(current_date):
+    """
+    Loads the stocks of the portfolio with `current_date` falling between their week_start_date and week_end_date
+    """
+    db_path = os.getenv("DB_PATH")
+    conn = sqlite3.connect(db_path)
+    try:
+        return pd.read_sql_query(
+            "SELECT * FROM portfolio WHERE week_end_date >= ? AND week_start_date <= ? LIMIT 10",
+            conn,
+            params=(str(current_date), str(current_date)),
+        )
+    finally:
+        conn.close()
+
+
+async def send_paper_buy_embed(bot_channel: TextChannel):
+    """
+    Sends the paper buy embed with the stocks that were just purchased, as activated by the paper buy cron job every Monday
+    """
+    df_stocks = await run_io(load_paper_buys)
 
     today_str = datetime.datetime.now().strftime("%x")
     total_cost = df_stocks["price"].sum()
 
-    conn.close()
-
-    img_buf = dataframe_to_image(df_stocks, "", money_cols=["price"])
+    img_buf = await run_cpu(dataframe_to_image, df_stocks, "", money_cols=["price"])
 
     # Create and send the embed
     file = discord.File(img_buf, filename="send_paper_buy_embed.png")
@@ -388,15 +486,9 @@ async def send_paper_sell_embed(bot_channel: TextChannel):
     """
     Sends the paper sell embed with the stocks that were just sold, as activated by the paper sell cron job every Sunday
     """
-    db_path = os.getenv("DB_PATH")
-    conn = sqlite3.connect(db_path)
-
     # Use the current date to find the stocks with the current date falling between their week_start_date and week_end_date
     current_date = datetime.datetime.now().date()
-    df_stocks = pd.read_sql_query(
-        f"SELECT * FROM portfolio WHERE week_end_date >= '{current_date}' AND week_start_date <= '{current_date}' LIMIT 10",
-        conn,
-    )
+    df_stocks = await run_io(load_paper_sells, current_date)
 
     # From query, calculate total cost of the week and total gain/loss
     total_cost = df_stocks["total_cost"].sum()
@@ -404,8 +496,6 @@ async def send_paper_sell_embed(bot_channel: TextChannel):
     days_since_monday = datetime.datetime.now().weekday()  # 0 for Monday, 6 for Sunday
     start_day = datetime.datetime.now() - datetime.timedelta(days=days_since_monday)
 
-    conn.close()
-
     df_stocks = df_stocks[
         [
             "stock_symbol",
@@ -415,7 +505,8 @@ async def send_paper_sell_embed(bot_channel: TextChannel):
         ]
     ]
 
-    img_buf = dataframe_to_image(
+    img_buf = await run_cpu(
+        dataframe_to_image,
         df_stocks,
         "weekly_profit_loss",
         money_cols=["total_cost", "weekly_profit_loss"],
@@ -488,9 +579,20 @@ def cron_watch(e):
             subprocess.run(["chmod", "777", cron_env_path])
 
 
-watch_thread = threading.Thread(target=cron_watch, args=(stop_event,))
-watch_thread.start()
+# The workflow's worker processes re-import this module, so only the real bot process may start anything
+if __name__ == "__main__":
+    # Make sure this is the only instance running if attempted to run manually
+    if len(sys.argv) == 2 and sys.argv[1] == "-s":
+        print("Running with systemd")
+    else:
+        result = subprocess.run(["systemctl", "is-active", "bot"], stdout=subprocess.PIPE)
+        is_running_already = result.stdout == b"active\n"
+        if is_running_already:
+            print("Bot is already running in systemd. Please stop it first!")
+            exit(1)
 
+    watch_thread = threading.Thread(target=cron_watch, args=(stop_event,))
+    watch_thread.start()
 
-# Run the bot
-bot.run(TOKEN)
+    # Run the bot
+    bot.run(TOKEN)
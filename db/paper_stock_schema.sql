@@ -35,12 +35,31 @@ CREATE TABLE portfolio (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE TABLE IF NOT EXISTS top_stocks {
-    run_id SERIAL PRIMARY KEY,
-    run_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    stock_id INT REFERENCES stocks(stock_id),
-    rank INT NOT NULL (rank >= 1)
-}
+-- Table: ranking_runs, one row per ranking of the stocks (written by top_stock.run_ranking)
+CREATE TABLE IF NOT EXISTS ranking_runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_at TIMESTAMP NOT NULL,
+    run_date DATE NOT NULL,
+    model_fingerprint TEXT,
+    valuation TEXT,
+    stocks INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS ranking_runs_date ON ranking_runs (run_date, run_id);
+
+-- Table: top_stocks, every ranked stock of a run with its predicted return and the features it was predicted from
+CREATE TABLE IF NOT EXISTS top_stocks (
+    run_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL CHECK (rank >= 1),
+    symbol TEXT NOT NULL,
+    current_price REAL,
+    predicted_return REAL,
+    valuation_gap REAL,
+    avg_compound_sentiment REAL,
+    market_cap REAL,
+    PRIMARY KEY (run_id, rank),
+    FOREIGN KEY (run_id) REFERENCES ranking_runs(run_id)
+);
 
 
 
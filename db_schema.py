@@ -0,0 +1,351 @@
+import sqlite3
+
+from news_dedupe import canonical_url
+
+
+def create_tech_stocks_table(conn: sqlite3.Connection):
+    """
+    Creates the `tech_stocks` table, holding the screened stocks of the sector and their valuation
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tech_stocks (
+            symbol TEXT PRIMARY KEY,
+            name TEXT,
+            market_cap REAL,
+            sector TEXT,
+            current_eps REAL,
+            projected_eps REAL,
+            stock_pe_ratio_forward REAL,
+            stock_pe_ratio_trailing REAL,
+            earnings_growth REAL,
+            dividend_yield REAL,
+            beta REAL,
+            current_price REAL,
+            intrinsic_value REAL,
+            fair_value REAL,
+            valuation_gap REAL,
+            valuation TEXT
+        )
+        """
+    )
+    conn.commit()
+
+
+def create_sentiments_table(conn: sqlite3.Connection):
+    """
+    Creates the `sentiments` table, holding the VADER scores of every analyzed article.
+    `source` is what was scored: the Finnhub `summary` or the full `page`.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sentiments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            article_id INTEGER,
+            url TEXT,
+            score_neg REAL,
+            score_neu REAL,
+            score_pos REAL,
+            score_compound REAL,
+            overall_sentiment TEXT,
+            source TEXT NOT NULL DEFAULT 'page',
+            FOREIGN KEY (article_id) REFERENCES news(id),
+            UNIQUE (article_id)
+        )
+        """
+    )
+
+    # Older databases were created without source, when every article was scored from its page
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(sentiments)")]
+    if "source" not in columns:
+        conn.execute("ALTER TABLE sentiments ADD COLUMN source TEXT NOT NULL DEFAULT 'page'")
+    conn.commit()
+
+
+def create_ticker_sentiment_table(conn: sqlite3.Connection):
+    """
+    Creates the `ticker_sentiment` table, a per-ticker aggregate of `sentiments` (sum and count of `score_compound`).
+    Triggers on `sentiments` keep it up to date at insert time, so readers only need one row per ticker.
+    """
+    create_sentiments_table(conn)
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS ticker_sentiment (
+            ticker TEXT PRIMARY KEY,
+            score_sum REAL NOT NULL DEFAULT 0,
+            score_count INTEGER NOT NULL DEFAULT 0,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TRIGGER IF NOT EXISTS ticker_sentiment_insert
+        AFTER INSERT ON sentiments
+        WHEN NEW.score_compound IS NOT NULL
+        BEGIN
+            INSERT INTO ticker_sentiment (ticker, score_sum, score_count, last_updated)
+            SELECT ticker, NEW.score_compound, 1, CURRENT_TIMESTAMP FROM news WHERE id = NEW.article_id
+            ON CONFLICT (ticker) DO UPDATE SET
+                score_sum = score_sum + excluded.score_sum,
+                score_count = score_count + 1,
+                last_updated = excluded.last_updated;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS ticker_sentiment_delete
+        AFTER DELETE ON sentiments
+        WHEN OLD.score_compound IS NOT NULL
+        BEGIN
+            UPDATE ticker_sentiment
+            SET score_sum = score_sum - OLD.score_compound,
+                score_count = score_count - 1,
+                last_updated = CURRENT_TIMESTAMP
+            WHERE ticker = (SELECT ticker FROM news WHERE id = OLD.article_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS ticker_sentiment_update
+        AFTER UPDATE OF article_id, score_compound ON sentiments
+        BEGIN
+            UPDATE ticker_sentiment
+            SET score_sum = score_sum - OLD.score_compound,
+                score_count = score_count - 1,
+                last_updated = CURRENT_TIMESTAMP
+            WHERE OLD.score_compound IS NOT NULL
+              AND ticker = (SELECT ticker FROM news WHERE id = OLD.article_id);
+
+            INSERT INTO ticker_sentiment (ticker, score_sum, score_count, last_updated)
+            SELECT ticker, NEW.score_compound, 1, CURRENT_TIMESTAMP FROM news
+            WHERE id = NEW.article_id AND NEW.score_compound IS NOT NULL
+            ON CONFLICT (ticker) DO UPDATE SET
+                score_sum = score_sum + excluded.score_sum,
+                score_count = score_count + 1,
+                last_updated = excluded.last_updated;
+        END;
+        """
+    )
+
+    # Backfill the aggregate from the existing sentiments the first time it is created
+    if conn.execute("SELECT 1 FROM ticker_sentiment LIMIT 1").fetchone() is None:
+        conn.execute(
+            """
+            INSERT INTO ticker_sentiment (ticker, score_sum, score_count)
+            SELECT news.ticker, TOTAL(sentiments.score_compound), COUNT(sentiments.score_compound)
+            FROM sentiments
+            JOIN news ON news.id = sentiments.article_id
+            GROUP BY news.ticker
+            """
+        )
+    conn.commit()
+
+
+def create_fundamentals_cache_table(conn: sqlite3.Connection):
+    """
+    Creates the `fundamentals_cache` table, holding the compressed yfinance `.info` payload of every symbol,
+    when it was fetched and the next earnings date known at that time (all as unix timestamps)
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fundamentals_cache (
+            symbol TEXT PRIMARY KEY,
+            payload BLOB NOT NULL,
+            fetched_at REAL NOT NULL,
+            next_earnings_at REAL
+        )
+        """
+    )
+    conn.commit()
+
+
+def create_news_table(conn: sqlite3.Connection):
+    """
+    Creates the `news` table, holding the Finnhub articles of every ticker.
+    `canonical_url` is the normalized `url` (see `news_dedupe.canonical_url`), shared by every row linking to the same page.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS news (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticker TEXT NOT NULL,
+            category TEXT,
+            datetime TEXT NOT NULL,
+            headline TEXT NOT NULL,
+            image TEXT,
+            related TEXT,
+            source TEXT NOT NULL,
+            summary TEXT,
+            url TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            canonical_url TEXT,
+            FOREIGN KEY (ticker) REFERENCES tech_stocks(symbol),
+            UNIQUE (ticker, datetime, headline, source)
+        )
+        """
+    )
+
+    # Older databases were created without canonical_url, so add and backfill it
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(news)")]
+    if "canonical_url" not in columns:
+        conn.execute("ALTER TABLE news ADD COLUMN canonical_url TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS news_canonical_url ON news (canonical_url)")
+
+    missing = conn.execute("SELECT id, url FROM news WHERE canonical_url IS NULL").fetchall()
+    conn.executemany(
+        "UPDATE news SET canonical_url = ? WHERE id = ?",
+        [(canonical_url(url), article_id) for article_id, url in missing],
+    )
+    conn.commit()
+
+
+def create_ingest_state_table(conn: sqlite3.Connection):
+    """
+    Creates the `ingest_state` table, holding the last date each ticker's news was fetched up to (its high-water mark)
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ingest_state (
+            ticker TEXT PRIMARY KEY,
+            fetched_to TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    conn.commit()
+
+
+def create_news_clusters_table(conn: sqlite3.Connection):
+    """
+    Creates the `news_clusters` table, assigning every article to a cluster of near-duplicate stories
+    (see `news_dedupe.NewsClusterer`). `crawl_key` is the canonical URL of the page scraped for the whole cluster.
+    """
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS news_clusters (
+            article_id INTEGER PRIMARY KEY,
+            simhash INTEGER NOT NULL,
+            cluster_id INTEGER NOT NULL,
+            crawl_key TEXT NOT NULL,
+            is_duplicate INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (article_id) REFERENCES news(id),
+            FOREIGN KEY (cluster_id) REFERENCES news(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS news_clusters_crawl_key ON news_clusters (crawl_key);
+        """
+    )
+    conn.commit()
+
+
+def create_domain_stats_table(conn: sqlite3.Connection):
+    """
+    Creates the `domain_stats` table, holding the crawl health of every publisher domain
+    (see `sentiment_scraper.middlewares.DomainHealthMiddleware`). `extracted` counts the responses that yielded
+    article text, and `latency_samples` is a JSON list of the most recent download latencies (in seconds).
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS domain_stats (
+            domain TEXT PRIMARY KEY,
+            requests INTEGER NOT NULL DEFAULT 0,
+            successes INTEGER NOT NULL DEFAULT 0,
+            extracted INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            latency_samples TEXT NOT NULL DEFAULT '[]',
+            median_latency REAL,
+            last_request_at REAL,
+            last_success_at REAL
+        )
+        """
+    )
+    conn.commit()
+
+
+def create_crawl_frontier_table(conn: sqlite3.Connection):
+    """
+    Creates the `crawl_frontier` table, the persistent crawl queue of `db_spider`. Every article waiting for its page
+    is `pending`, `in_flight` while its request is out, then `done` or, after too many `attempts`, `failed`.
+    Pages on a domain that is being skipped are `skipped` until the next crawl.
+    Articles sharing a `crawl_key` are fetched together, as one page.
+    In-flight articles are leased to the worker crawling them (`lease_owner`) until `lease_expires` (a unix timestamp).
+    """
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS crawl_frontier (
+            article_id INTEGER PRIMARY KEY,
+            crawl_key TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            lease_owner TEXT,
+            lease_expires REAL,
+            FOREIGN KEY (article_id) REFERENCES news(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS crawl_frontier_state ON crawl_frontier (state, crawl_key);
+        """
+    )
+
+    # Older frontiers were created before leases, when a single spider did all the crawling
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(crawl_frontier)")]
+    if "lease_owner" not in columns:
+        conn.execute("ALTER TABLE crawl_frontier ADD COLUMN lease_owner TEXT")
+        conn.execute("ALTER TABLE crawl_frontier ADD COLUMN lease_expires REAL")
+    conn.commit()
+
+
+def create_pipeline_runs_table(conn: sqlite3.Connection):
+    """
+    Creates the `pipeline_runs` table, recording every run of every pipeline stage (see `pipeline.py`).
+    `input_hash` and `output_hash` fingerprint what the stage consumed and what it left behind, and `status` is
+    `ok`, `skipped` (its inputs were unchanged since the last successful run) or `failed`.
+    """
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS pipeline_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stage TEXT NOT NULL,
+            status TEXT NOT NULL,
+            input_hash TEXT,
+            output_hash TEXT,
+            summary TEXT,
+            started_at REAL,
+            finished_at REAL
+        );
+
+        CREATE INDEX IF NOT EXISTS pipeline_runs_stage ON pipeline_runs (stage, status, id);
+        """
+    )
+    conn.commit()
+
+
+def create_ranking_tables(conn: sqlite3.Connection):
+    """
+    Creates the `ranking_runs` table, with one row per ranking of the stocks (see `top_stock.run_ranking`), and the
+    `top_stocks` table, holding every ranked stock of a run along with the model's predicted return and the features
+    it was predicted from. `model_fingerprint` is the data fingerprint of the model that made the predictions.
+    """
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS ranking_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_at TIMESTAMP NOT NULL,
+            run_date DATE NOT NULL,
+            model_fingerprint TEXT,
+            valuation TEXT,
+            stocks INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE INDEX IF NOT EXISTS ranking_runs_date ON ranking_runs (run_date, run_id);
+
+        CREATE TABLE IF NOT EXISTS top_stocks (
+            run_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL CHECK (rank >= 1),
+            symbol TEXT NOT NULL,
+            current_price REAL,
+            predicted_return REAL,
+            valuation_gap REAL,
+            avg_compound_sentiment REAL,
+            market_cap REAL,
+            PRIMARY KEY (run_id, rank),
+            FOREIGN KEY (run_id) REFERENCES ranking_runs(run_id)
+        );
+        """
+    )
+    conn.commit()
@@ -0,0 +1,96 @@
+# Executors the Discord bot runs its blocking work on, so the event loop (and the gateway heartbeat) never waits on it
+#
+# CPU-bound jobs (scoring the ranking model, rendering tables with matplotlib) run on a process pool, where they
+# neither hold the GIL nor share matplotlib's global state. Blocking I/O (SQLite, yfinance) runs on a thread pool.
+# Every job has a timeout, after which the caller gets an `asyncio.TimeoutError`. The job itself can't be interrupted
+# and finishes in the background, but nobody waits on it anymore.
+
+import asyncio
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Number of processes for CPU-bound jobs, and of threads for blocking I/O
+BOT_CPU_WORKERS = int(os.getenv("BOT_CPU_WORKERS", "2"))
+BOT_IO_WORKERS = int(os.getenv("BOT_IO_WORKERS", "8"))
+
+# How long a command waits on a single job before giving up
+BOT_JOB_TIMEOUT_SECONDS = float(os.getenv("BOT_JOB_TIMEOUT_SECONDS", "120"))
+
+_cpu_pool = None
+_io_pool = None
+_lock = threading.Lock()
+
+
+def cpu_pool():
+    global _cpu_pool
+    with _lock:
+        if _cpu_pool is None:
+            # Spawned rather than forked, since the bot process runs threads of its own (the cron watcher, the pipeline)
+            _cpu_pool = ProcessPoolExecutor(
+                max_workers=BOT_CPU_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _cpu_pool
+
+
+def io_pool():
+    global _io_pool
+    with _lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(max_workers=BOT_IO_WORKERS, thread_name_prefix="bot-io")
+        return _io_pool
+
+
+def _discard_cpu_pool(pool):
+    global _cpu_pool
+    with _lock:
+        if _cpu_pool is pool:
+            _cpu_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_cpu(fn, *args, timeout=BOT_JOB_TIMEOUT_SECONDS, **kwargs):
+    """
+    Runs `fn(*args, **kwargs)` on the process pool, returning its result. `fn`, its arguments and its result must be
+    picklable, so `fn` has to be a module-level function.
+    """
+    pool = cpu_pool()
+    try:
+        return await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(pool, functools.partial(fn, *args, **kwargs)),
+            timeout,
+        )
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for using too much memory), so the next jobs get a fresh pool
+        _discard_cpu_pool(pool)
+        raise
+
+
+async def run_io(fn, *args, timeout=BOT_JOB_TIMEOUT_SECONDS, **kwargs):
+    """
+    Runs `fn(*args, **kwargs)` on the thread pool, returning its result
+    """
+    return await asyncio.wait_for(
+        asyncio.get_running_loop().run_in_executor(io_pool(), functools.partial(fn, *args, **kwargs)),
+        timeout,
+    )
+
+
+def shutdown():
+    """
+    Stops both pools, without waiting on the jobs still running
+    """
+    global _cpu_pool, _io_pool
+    with _lock:
+        pools = [pool for pool in (_cpu_pool, _io_pool) if pool is not None]
+        _cpu_pool = _io_pool = None
+    for pool in pools:
+        pool.shutdown(wait=False, cancel_futures=True)
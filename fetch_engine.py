@@ -0,0 +1,121 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter. Tokens are refilled continuously at `rate` per second, up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then takes it
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _fetch_with_retries(key, fetch_fn, bucket, retries, backoff):
+    """
+    Calls `fetch_fn(key)` once a token is available, retrying with exponential backoff (and jitter) on failure
+    """
+    attempt = 0
+    while True:
+        bucket.acquire()
+        try:
+            return fetch_fn(key)
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+            attempt += 1
+
+
+def fetch_concurrently(keys, fetch_fn, max_in_flight=8, rate_per_second=5.0, retries=3, backoff=1.0, progress=print):
+    """
+    Calls `fetch_fn` for every key on a bounded thread pool, rate limited by a token bucket.
+    Yields `(key, result, error)` tuples as each fetch completes; `error` is the exception raised once the retries
+    were exhausted, or `None` on success. A progress line is printed per key so it streams through the workflow.
+    """
+    keys = list(keys)
+    bucket = TokenBucket(rate_per_second)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {
+            executor.submit(_fetch_with_retries, key, fetch_fn, bucket, retries, backoff): key
+            for key in keys
+        }
+
+        count = 1
+        for future in as_completed(futures):
+            key = futures[future]
+            progress(f"Processed {key} ({count}/{len(keys)})")
+            count += 1
+
+            try:
+                yield key, future.result(), None
+            except Exception as e:
+                yield key, None, e
+
+
+class AsyncTokenBucket:
+    """
+    asyncio flavour of `TokenBucket`. `pause` empties the bucket for a while, e.g. after the server answered 429.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """
+        Waits until a token is available, then takes it
+        """
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Stops handing out tokens for `seconds`, and starts refilling from empty afterwards
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.updated = self.paused_until
@@ -1,68 +1,102 @@
-# https://finnhub.io/docs/api/market-news
+# https://finnhub.io/docs/api/company-news
 
-import finnhub
+import asyncio
 import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from datetime import date, timedelta
-import time
+from datetime import date, datetime, timedelta
+
+import aiohttp
+from db_schema import create_ingest_state_table, create_news_clusters_table, create_news_table
+from fetch_engine import AsyncTokenBucket
+from news_dedupe import NewsClusterer, canonical_url
 
 load_dotenv()
 
 SQLITE_DATABASE_PATH = os.getenv("DB_PATH")
 FINNHUB_API_KEY = os.getenv("FINNHUB_API_KEY")
+FINNHUB_COMPANY_NEWS_URL = "https://finnhub.io/api/v1/company-news"
+
+# Free tier limit is 60 calls per minute
+FINNHUB_CALLS_PER_MINUTE = int(os.getenv("FINNHUB_CALLS_PER_MINUTE", "60"))
+FINNHUB_MAX_IN_FLIGHT = int(os.getenv("FINNHUB_MAX_IN_FLIGHT", "4"))
+FINNHUB_RETRIES = int(os.getenv("FINNHUB_RETRIES", "5"))
+
+# Days re-requested before each ticker's high-water mark, to catch articles published late
+NEWS_OVERLAP_DAYS = int(os.getenv("NEWS_OVERLAP_DAYS", "2"))
+
+
+async def fetch_company_news(session, bucket, ticker, from_date, to_date):
+    """
+    Fetches the company news of the ticker between the two dates, backing off whenever Finnhub answers 429
+    """
+    params = {"symbol": ticker, "from": from_date, "to": to_date}
+    attempt = 0
+    while True:
+        await bucket.acquire()
+        async with session.get(FINNHUB_COMPANY_NEWS_URL, params=params) as response:
+            if response.status == 429 and attempt < FINNHUB_RETRIES:
+                # Rate limited, so stop every request for a while (honoring Retry-After if given)
+                retry_after = response.headers.get("Retry-After")
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+                bucket.pause(delay)
+                attempt += 1
+                continue
+
+            response.raise_for_status()
+            return await response.json()
+
+
+def load_marks(conn):
+    """
+    Returns each ticker's high-water mark: the date it was last fetched up to, or else the date of its newest stored article
+    """
+    marks = dict(conn.execute("SELECT ticker, fetched_to FROM ingest_state").fetchall())
+    for ticker, newest in conn.execute("SELECT ticker, MAX(CAST(datetime AS INTEGER)) FROM news GROUP BY ticker"):
+        if ticker not in marks and newest:
+            marks[ticker] = datetime.fromtimestamp(newest).date().isoformat()
+    return marks
+
+
+def from_date(marks, ticker, window_start):
+    """
+    Returns the date the ticker's news should be fetched from: its high-water mark minus a small overlap,
+    but never before the start of the window
+    """
+    start = window_start
+    if ticker in marks:
+        start = max(window_start, date.fromisoformat(marks[ticker]) - timedelta(days=NEWS_OVERLAP_DAYS))
+    return start.isoformat()
+
 
-conn = sqlite3.connect(SQLITE_DATABASE_PATH)
-
-finnhub_client = finnhub.Client(api_key=FINNHUB_API_KEY)
-
-n_days_ago = int(os.getenv("N_DAYS_AGO")) # Free tier limit is 365 days, determines how many days back to fetch news from
-
-from_date = (date.today() - timedelta(days=n_days_ago)).isoformat()
-to_date = date.today().isoformat()
-
-cur = conn.cursor()
-
-market_cap_threshold = os.getenv("MARKET_CAP_THRESHOLD")
-
-tickers = conn.execute(f"SELECT symbol FROM tech_stocks WHERE market_cap > {market_cap_threshold} AND valuation = \"undervalued\"").fetchall()
-tickers = [ticker[0] for ticker in tickers] # convert from list of tuples to list of strings
-
-print(f"Found {len(tickers)} tech stocks in the database.")
-
-# Create the news table
-cur.execute("""
-CREATE TABLE IF NOT EXISTS news (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    ticker TEXT NOT NULL,
-    category TEXT,
-    datetime TEXT NOT NULL,
-    headline TEXT NOT NULL,
-    image TEXT,
-    related TEXT,
-    source TEXT NOT NULL,
-    summary TEXT,
-    url TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (ticker) REFERENCES tech_stocks(symbol),
-    UNIQUE (ticker, datetime, headline, source)
-);
-""")
-
-# Fetch news for each ticker
-ticker_count = 1
-for ticker in tickers:
-    result = finnhub_client.company_news(ticker, _from=from_date, to=to_date)
-
-    insert_count = 0
-    skip_count = 0
-
-    # For every article found, insert into the database
-    for article in result:
-        cur.execute("""
-        INSERT OR IGNORE INTO news (ticker, category, datetime, headline, image, related, source, summary, url)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
-        """, (
+def get_from_dates(conn, tickers, window_start):
+    """
+    Returns the date each ticker's news should be fetched from (see `from_date`)
+    """
+    marks = load_marks(conn)
+    return {ticker: from_date(marks, ticker, window_start) for ticker in tickers}
+
+
+async def stream_from_dates(conn, tickers, window_start):
+    """
+    Pairs every ticker of the async iterable `tickers` with the date its news should be fetched from, as they arrive
+    """
+    marks = load_marks(conn)
+    async for ticker in tickers:
+        yield ticker, from_date(marks, ticker, window_start)
+
+
+def insert_articles(conn, ticker, articles):
+    """
+    Inserts the articles of a ticker with a single `executemany`, returning how many were new
+    """
+    changes_before = conn.total_changes
+    conn.executemany("""
+    INSERT OR IGNORE INTO news (ticker, category, datetime, headline, image, related, source, summary, url, canonical_url)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+    """, [
+        (
             ticker,
             article.get("category"),
             article.get("datetime"),
@@ -71,26 +105,154 @@ for ticker in tickers:
             article.get("related"),
             article.get("source"),
             article.get("summary"),
-            article.get("url")
-        ))
-
-        if cur.rowcount > 0:  # Check if a row was actually inserted
-            insert_count += 1
-        else:
-            skip_count += 1
+            article.get("url"),
+            canonical_url(article.get("url") or "")
+        )
+        for article in articles
+    ])
+    conn.commit()
+    return conn.total_changes - changes_before
 
-    time.sleep(1.05) # Sleep for 1.05 seconds to avoid rate limiting
 
-    # Commit the changes after processing all articles for this ticker
+def store_news(conn, clusterer, ticker, articles, to_date):
+    """
+    Stores the articles of a ticker, clusters the new ones with their near-duplicates and moves the ticker's
+    high-water mark to `to_date`. Returns how many articles were new, and how many of those were syndicated copies.
+    """
+    insert_count = insert_articles(conn, ticker, articles)
+    duplicate_count = clusterer.cluster_pending()
+    conn.execute(
+        "INSERT OR REPLACE INTO ingest_state (ticker, fetched_to, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+        (ticker, to_date),
+    )
     conn.commit()
+    return insert_count, duplicate_count
+
+
+async def ingest_news(conn, clusterer, from_dates, to_date, progress=print, on_ingested=None):
+    """
+    Fetches the news of every ticker (from its own start date) with several requests in flight, limited to the plan's
+    calls per minute, and stores them as each response arrives (see `store_news`). Returns how many new articles
+    were stored. `from_dates` maps every ticker to its start date, or is an async iterator of (ticker, start date)
+    pairs when the tickers are streamed in by an earlier stage. `on_ingested(ticker)` is called once a ticker's news
+    is stored.
+    Storing (and `on_ingested`) runs on a writer thread, so `conn` must be opened with `check_same_thread=False`.
+    """
+    bucket = AsyncTokenBucket(FINNHUB_CALLS_PER_MINUTE / 60, capacity=FINNHUB_MAX_IN_FLIGHT)
+    semaphore = asyncio.Semaphore(FINNHUB_MAX_IN_FLIGHT)
+    ticker_count = 1
+    inserted = 0
+
+    # Storing is blocking SQLite work, which can wait on the crawl's writes, so it runs off the event loop and the
+    # other fetches keep going meanwhile. A single thread does all of it, as the connection is shared.
+    loop = asyncio.get_running_loop()
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="news-writer")
+
+    def store(ticker, result):
+        counts = store_news(conn, clusterer, ticker, result, to_date)
+        if on_ingested is not None:
+            on_ingested(ticker)
+        return counts
+
+    async def fetch(session, ticker, start):
+        nonlocal ticker_count, inserted
+        async with semaphore:
+            try:
+                result = await fetch_company_news(session, bucket, ticker, start, to_date)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                progress(f"{ticker} (#{ticker_count}):\tFailed to fetch articles: {e}")
+                ticker_count += 1
+                return
+
+        # For every article found, insert into the database
+        insert_count, duplicate_count = await loop.run_in_executor(writer, store, ticker, result)
+        inserted += insert_count
+        skip_count = len(result) - insert_count
+
+        # Print the summary for this ticker
+        progress(f"{ticker} (#{ticker_count}):\tFound {len(result)} articles since {start}, inserted {insert_count} new articles ({duplicate_count} syndicated copies), skipped {skip_count} duplicate articles.")
+        ticker_count += 1
+
+    if isinstance(from_dates, dict):
+        from_dates = aiter_items(from_dates)
+
+    headers = {"X-Finnhub-Token": FINNHUB_API_KEY or ""}
+    try:
+        async with aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=60)) as session:
+            tasks = [asyncio.create_task(fetch(session, ticker, start)) async for ticker, start in from_dates]
+            await asyncio.gather(*tasks)
+    finally:
+        # The caller gets the connection back once nothing is writing to it anymore
+        writer.shutdown(wait=True)
+
+    return inserted
+
+
+async def aiter_items(mapping):
+    for item in mapping.items():
+        yield item
+
+
+def run_ingest(conn, progress=print):
+    """
+    Fetches the news of every undervalued stock since it was last fetched, returning how many new articles were stored.
+    `conn` must be opened with `check_same_thread=False` (see `ingest_news`).
+    """
+    n_days_ago = int(os.getenv("N_DAYS_AGO")) # Free tier limit is 365 days, determines how many days back to fetch news from
+
+    window_start = date.today() - timedelta(days=n_days_ago)
+    to_date = date.today().isoformat()
+
+    market_cap_threshold = int(os.getenv("MARKET_CAP_THRESHOLD"))
+
+    tickers = conn.execute("SELECT symbol FROM tech_stocks WHERE market_cap > ? AND valuation = 'undervalued'", (market_cap_threshold,)).fetchall()
+    tickers = [ticker[0] for ticker in tickers] # convert from list of tuples to list of strings
+
+    progress(f"Found {len(tickers)} tech stocks in the database.")
+
+    # Create the news table, and the table tracking how far each ticker's news has been fetched
+    create_news_table(conn)
+    create_ingest_state_table(conn)
+    create_news_clusters_table(conn)
+
+    # Cluster any article that isn't yet (e.g. stored before clustering existed), then keep the index for new ones
+    clusterer = NewsClusterer(conn)
+    clusterer.cluster_pending()
+
+    # Fetch news for each ticker, only since what was fetched last time
+    from_dates = get_from_dates(conn, tickers, window_start)
+    return asyncio.run(ingest_news(conn, clusterer, from_dates, to_date, progress))
+
+
+def run_ingest_stream(conn, tickers, progress=print, on_ingested=None):
+    """
+    Fetches the news of the tickers of the async iterable `tickers` as they arrive (e.g. as they are valued), returning
+    how many new articles were stored. `on_ingested(ticker)` is called once a ticker's news is stored and clustered,
+    on the thread storing the news. `conn` must be opened with `check_same_thread=False` (see `ingest_news`).
+    """
+    window_start = date.today() - timedelta(days=int(os.getenv("N_DAYS_AGO")))
+    to_date = date.today().isoformat()
+
+    create_news_table(conn)
+    create_ingest_state_table(conn)
+    create_news_clusters_table(conn)
+    clusterer = NewsClusterer(conn)
+    clusterer.cluster_pending()
+
+    async def ingest():
+        from_dates = stream_from_dates(conn, tickers, window_start)
+        return await ingest_news(conn, clusterer, from_dates, to_date, progress, on_ingested)
 
-    # Print the summary for this ticker
-    print(f"{ticker} (#{ticker_count}):\tFound {len(result)} articles, inserted {insert_count} new articles, skipped {skip_count} duplicate articles.")
-    ticker_count += 1
+    return asyncio.run(ingest())
 
-# Close the connection
-conn.close()
 
+def main():
+    conn = sqlite3.connect(SQLITE_DATABASE_PATH, check_same_thread=False)
+    run_ingest(conn)
 
+    # Close the connection
+    conn.close()
 
 
+if __name__ == "__main__":
+    main()
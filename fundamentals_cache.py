@@ -0,0 +1,66 @@
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+from db_schema import create_fundamentals_cache_table
+
+# How long a cached `.info` payload is used before it is refetched
+FUNDAMENTALS_CACHE_TTL_HOURS = float(os.getenv("FUNDAMENTALS_CACHE_TTL_HOURS", "168"))
+
+# Keys of the `.info` blob holding earnings dates, as unix timestamps
+EARNINGS_KEYS = ["earningsTimestamp", "earningsTimestampStart", "earningsTimestampEnd"]
+
+
+def next_earnings_at(info, now):
+    """
+    Returns the earliest earnings date in the `.info` blob that is still in the future, or `None`
+    """
+    upcoming = [
+        info[key] for key in EARNINGS_KEYS
+        if isinstance(info.get(key), (int, float)) and info[key] > now
+    ]
+    return min(upcoming) if upcoming else None
+
+
+def load_cached_info(conn: sqlite3.Connection, symbols, ttl_hours=FUNDAMENTALS_CACHE_TTL_HOURS, now=None):
+    """
+    Returns `{symbol: info}` for the symbols whose cached payload is still fresh, meaning it is younger than the TTL
+    and no earnings report has come out since it was fetched
+    """
+    create_fundamentals_cache_table(conn)
+    now = time.time() if now is None else now
+    symbols = set(symbols)
+
+    cached = {}
+    for symbol, payload, fetched_at, earnings_at in conn.execute(
+        "SELECT symbol, payload, fetched_at, next_earnings_at FROM fundamentals_cache"
+    ):
+        if symbol not in symbols:
+            continue
+        if now - fetched_at >= ttl_hours * 3600:
+            continue
+        if earnings_at is not None and earnings_at <= now:
+            continue
+        cached[symbol] = json.loads(zlib.decompress(payload))
+    return cached
+
+
+def store_info(conn: sqlite3.Connection, infos, now=None):
+    """
+    Stores the freshly fetched `{symbol: info}` payloads in the cache
+    """
+    create_fundamentals_cache_table(conn)
+    now = time.time() if now is None else now
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO fundamentals_cache (symbol, payload, fetched_at, next_earnings_at)
+        VALUES (?, ?, ?, ?)
+        """,
+        [
+            (symbol, zlib.compress(json.dumps(info, default=str).encode("utf-8")), now, next_earnings_at(info, now))
+            for symbol, info in infos.items()
+        ],
+    )
+    conn.commit()
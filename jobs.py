@@ -0,0 +1,71 @@
+# Single-flight coordination of the bot's jobs
+#
+# A job is identified by a key. While a job is running, asking for the same key attaches to it instead of starting the
+# same work again, and every caller gets the same result (or exception). The job is forgotten as soon as it ends,
+# however it ends, so a failed job never blocks the requests after it.
+#
+# Jobs live on the bot's event loop, and are only ever started and joined from it.
+
+import asyncio
+
+
+class Job:
+    """
+    A running job. `status` is its latest progress message, for the callers attached to it to show.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.status = ""
+        self.task = None
+
+    async def result(self):
+        """
+        Waits for the job's result. A caller giving up (e.g. cancelled) doesn't cancel the job for everybody else.
+        """
+        return await asyncio.shield(self.task)
+
+
+class SingleFlight:
+    """
+    Runs at most one job per key at a time
+    """
+
+    def __init__(self):
+        self.jobs = {}
+
+    def join(self, key, run):
+        """
+        Returns the job running under `key`, along with whether this call started it. If there is none,
+        `run(job)` is started as a new one.
+        """
+        job = self.jobs.get(key)
+        if job is not None and not job.task.done():
+            return job, False
+
+        job = Job(key)
+        job.task = asyncio.ensure_future(run(job))
+        self.jobs[key] = job
+        job.task.add_done_callback(lambda task: self.forget(job))
+        return job, True
+
+    def forget(self, job):
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+
+        # Every attached caller may have given up already, so the exception is retrieved here, not to be logged
+        # as never retrieved
+        if not job.task.cancelled():
+            job.task.exception()
+
+    def running(self, key):
+        job = self.jobs.get(key)
+        return job is not None and not job.task.done()
+
+    async def settled(self, key):
+        """
+        Waits for the job running under `key` (if any) to end, whatever its outcome
+        """
+        job = self.jobs.get(key)
+        if job is not None:
+            await asyncio.wait([job.task])
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import re
+from collections import defaultdict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Query parameters that only track where a click came from, and never change the page
+TRACKING_PARAMS = {
+    "fbclid",
+    "gclid",
+    "dclid",
+    "msclkid",
+    "mc_cid",
+    "mc_eid",
+    "cmpid",
+    "ncid",
+    "guccounter",
+    "guce_referrer",
+    "guce_referrer_sig",
+    "soc_src",
+    "soc_trk",
+    "sr_share",
+    "tsrc",
+    "yptr",
+}
+TRACKING_PREFIXES = ("utm_",)
+
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def canonical_url(url):
+    """
+    Normalizes an article URL so every link to the same page maps to the same string: lowercase scheme and host,
+    no default port or fragment, tracking parameters stripped and the remaining query parameters sorted
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or "http"
+
+    netloc = parts.netloc.lower()
+    host, _, port = netloc.rpartition(":")
+    if host and port == DEFAULT_PORTS.get(scheme):
+        netloc = host
+
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not is_tracking_param(name)
+    )
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query), ""))
+
+
+# Near-duplicate detection: articles whose headline + summary SimHashes differ in at most this many bits are the
+# same story. The 64-bit hash is split into SIMHASH_MAX_DISTANCE + 1 bands, so near-duplicates always share a band.
+SIMHASH_BITS = 64
+SIMHASH_MAX_DISTANCE = int(os.getenv("SIMHASH_MAX_DISTANCE", "3"))
+SIMHASH_BANDS = SIMHASH_MAX_DISTANCE + 1
+
+# Only articles published this close together can be copies of each other (templated daily stories are not)
+SYNDICATION_WINDOW_SECONDS = float(os.getenv("SYNDICATION_WINDOW_DAYS", "2")) * 86400
+
+
+def simhash(text):
+    """
+    64-bit SimHash of the text, over its 3-word shingles
+    """
+    tokens = re.findall(r"[a-z0-9]+", text.lower())
+    shingles = [" ".join(tokens[i:i + 3]) for i in range(max(1, len(tokens) - 2))]
+
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+
+def to_sqlite_int(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def from_sqlite_int(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def bands(value):
+    width = SIMHASH_BITS // SIMHASH_BANDS
+    return [(band, value >> (band * width) & ((1 << width) - 1)) for band in range(SIMHASH_BANDS)]
+
+
+class NewsClusterer:
+    """
+    Groups `news` rows into clusters of near-duplicate stories, recorded in `news_clusters`.
+    Each cluster is represented by its first article, whose canonical URL is the cluster's `crawl_key`: the only page
+    of the cluster that gets scraped. Within a cluster only the first article of each ticker counts, later copies
+    are flagged `is_duplicate` so syndication doesn't weigh a story several times in a ticker's average sentiment.
+    The `news_clusters` table must exist (see `db_schema.create_news_clusters_table`).
+    Only the clusters an unclustered article could still join are loaded, i.e. those whose first article was published
+    within `SYNDICATION_WINDOW_SECONDS` of it, so memory doesn't grow with the whole news history.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.index = defaultdict(list)  # (band, band value) -> [(simhash, published, cluster_id, crawl_key)]
+        self.cluster_tickers = set()  # (cluster_id, ticker) already counted
+        self.loaded_since = None  # Publication time from which the clusters are loaded
+
+    def load_clusters(self, since):
+        """
+        Loads the clusters whose first article was published from `since` on, unless they already are
+        """
+        if self.loaded_since is not None and since >= self.loaded_since:
+            return
+
+        query = """
+            SELECT news_clusters.article_id, news_clusters.simhash, news_clusters.cluster_id, news_clusters.crawl_key,
+                   news.ticker, CAST(head.datetime AS INTEGER)
+            FROM news_clusters
+            JOIN news ON news.id = news_clusters.article_id
+            JOIN news AS head ON head.id = news_clusters.cluster_id
+            WHERE CAST(head.datetime AS INTEGER) >= ?
+        """
+        params = (since,)
+        if self.loaded_since is not None:
+            query += " AND CAST(head.datetime AS INTEGER) < ?"
+            params = (since, self.loaded_since)
+
+        for article_id, value, cluster_id, crawl_key, ticker, published in self.conn.execute(query, params):
+            if article_id == cluster_id:
+                self.add_to_index(from_sqlite_int(value), published, cluster_id, crawl_key)
+            self.cluster_tickers.add((cluster_id, ticker))
+        self.loaded_since = since
+
+    def add_to_index(self, value, published, cluster_id, crawl_key):
+        for band in bands(value):
+            self.index[band].append((value, published, cluster_id, crawl_key))
+
+    def find_cluster(self, value, published):
+        for band in bands(value):
+            for other, other_published, cluster_id, crawl_key in self.index.get(band, []):
+                if abs(published - other_published) > SYNDICATION_WINDOW_SECONDS:
+                    continue
+                if bin(value ^ other).count("1") <= SIMHASH_MAX_DISTANCE:
+                    return cluster_id, crawl_key
+        return None
+
+    def cluster_pending(self):
+        """
+        Assigns a cluster to every `news` row that doesn't have one yet, oldest first. Returns how many were duplicates.
+        """
+        rows = self.conn.execute(
+            """
+            SELECT news.id, news.ticker, news.headline, news.summary, news.canonical_url, CAST(news.datetime AS INTEGER)
+            FROM news
+            LEFT JOIN news_clusters ON news_clusters.article_id = news.id
+            WHERE news_clusters.article_id IS NULL
+            ORDER BY news.id
+            """
+        ).fetchall()
+        if rows:
+            self.load_clusters(min(row[5] for row in rows) - SYNDICATION_WINDOW_SECONDS)
+
+        clustered = []
+        duplicates = 0
+        for article_id, ticker, headline, summary, url, published in rows:
+            value = simhash(f"{headline or ''} {summary or ''}")
+            match = self.find_cluster(value, published)
+            if match is None:
+                cluster_id, crawl_key = article_id, url
+                self.add_to_index(value, published, cluster_id, crawl_key)
+            else:
+                cluster_id, crawl_key = match
+
+            is_duplicate = (cluster_id, ticker) in self.cluster_tickers
+            self.cluster_tickers.add((cluster_id, ticker))
+            duplicates += is_duplicate
+            clustered.append((article_id, to_sqlite_int(value), cluster_id, crawl_key, int(is_duplicate)))
+
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT OR REPLACE INTO news_clusters (article_id, simhash, cluster_id, crawl_key, is_duplicate)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                clustered,
+            )
+        return duplicates
@@ -3,13 +3,20 @@ import sqlite3
 import pandas as pd
 import yfinance as yf
 import os
-from top_stock import pick_top_Stock
+from top_stock import latest_top_stocks
 from datetime import datetime
 from dotenv import load_dotenv, set_key
+from fetch_engine import fetch_concurrently
 
 
 load_dotenv()
 
+# Concurrency and rate limiting of the price fetches, shared with the fundamentals fetcher
+FETCH_MAX_IN_FLIGHT = int(os.getenv("FETCH_MAX_IN_FLIGHT", "8"))
+FETCH_RATE_PER_SECOND = float(os.getenv("FETCH_RATE_PER_SECOND", "5"))
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "3"))
+FETCH_BACKOFF_SECONDS = float(os.getenv("FETCH_BACKOFF_SECONDS", "1.0"))
+
 
 # Function to insert paper trade record into the database
 def insert_trade(conn, stock_symbol, trade_type, quantity, price, trade_status="open"):
@@ -29,8 +36,8 @@ def insert_trade(conn, stock_symbol, trade_type, quantity, price, trade_status="
 def create_paper_trades_from_top_stocks(
     n=int(os.getenv("TOP_N_STOCKS")), quantity=int(os.getenv("TOP_STOCKS_QUANTITY"))
 ):
-    # Run the pick_top_stocks function to get top stocks
-    df_top_stocks = pick_top_Stock(n)
+    # Get the top stocks of the latest nightly ranking
+    df_top_stocks = latest_top_stocks(n)
 
     # Connect to the database
     db_path = os.getenv("DB_PATH")
@@ -62,6 +69,28 @@ def get_current_price(stock_symbol):
     return round(current_price, 2)
 
 
+def get_current_prices(stock_symbols):
+    """
+    Fetches the current price of every symbol concurrently, returning a `{symbol: price}` dict.
+    Raises the error of the first symbol whose price could not be fetched.
+    """
+    prices = {}
+    results = fetch_concurrently(
+        set(stock_symbols),
+        get_current_price,
+        max_in_flight=FETCH_MAX_IN_FLIGHT,
+        rate_per_second=FETCH_RATE_PER_SECOND,
+        retries=FETCH_RETRIES,
+        backoff=FETCH_BACKOFF_SECONDS,
+        progress=lambda message: None,
+    )
+    for symbol, price, error in results:
+        if error is not None:
+            raise error
+        prices[symbol] = price
+    return prices
+
+
 def get_current_stocks_profit_loss(stock_symbols=None):
     try:
         # Connect to the database
@@ -98,9 +127,8 @@ def get_current_stocks_profit_loss(stock_symbols=None):
         )
 
         # Fetch current prices and calculate profit/loss
-        df_active_trades["current_price"] = df_active_trades["stock_symbol"].apply(
-            get_current_price
-        )
+        prices = get_current_prices(df_active_trades["stock_symbol"])
+        df_active_trades["current_price"] = df_active_trades["stock_symbol"].map(prices)
         df_active_trades["total_gain_loss"] = (
             df_active_trades["current_price"] - df_active_trades["price"]
         ) * df_active_trades["quantity"]
@@ -187,10 +215,9 @@ def sell_all_open_stocks_and_calculate_gains():
         columns=["id", "stock_symbol", "trade_type", "quantity", "price", "trade_date"],
     )
 
-    # Add a column for the current price (retrieved using the get_current_price function)
-    df_open_trades["current_price"] = df_open_trades["stock_symbol"].apply(
-        get_current_price
-    )
+    # Add a column for the current price (retrieved using the get_current_prices function)
+    prices = get_current_prices(df_open_trades["stock_symbol"])
+    df_open_trades["current_price"] = df_open_trades["stock_symbol"].map(prices)
 
     # Calculate gain/loss for each trade
     df_open_trades["gain_loss"] = (
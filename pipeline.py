@@ -0,0 +1,605 @@
+# In-process runner of the nightly workflow
+#
+# Every step is a stage function taking the shared StageContext (and what it consumes from the previous stage), run on
+# a long-lived worker thread. The SQLite connection and the heavy imports (pandas, yfinance, Scrapy, ...) are kept warm
+# between runs, instead of paying for a new interpreter per step.
+#
+# After the screener, the stages overlap instead of waiting on each other: every ticker the valuation finds
+# undervalued goes straight to the news stage through a bounded queue, and every ticker's new articles go straight
+# into the crawl frontier, which the spiders keep following until the news stage is done.
+#
+# Every stage run is recorded in `pipeline_runs` with fingerprints of its inputs and outputs. A stage whose inputs
+# are the same as when it last succeeded is skipped, so rerunning the pipeline shortly after costs seconds. Run with
+# `--force` to run every stage anyway.
+#
+# Only one pipeline runs against a database at a time, across processes (the bot and the cron job alike): a run
+# started while another is going waits for it, and then mostly skips what the other one just did.
+
+import argparse
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import queue
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+import find_articles
+from db_schema import create_news_clusters_table, create_news_table, create_pipeline_runs_table
+from fundamentals_cache import load_cached_info
+import stock_valuation
+import tech_stock_list_dl
+
+load_dotenv()
+
+# Directory of the Scrapy project, which has to be importable for the crawl stage
+SCRAPY_PROJECT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sentiment_scraper")
+
+# Number of spiders crawling the frontier side by side, see sentiment_scraper.crawl_workers
+CRAWL_WORKERS = int(os.getenv("CRAWL_WORKERS", "4"))
+
+# Bound of the queue of undervalued tickers between the valuation and the news stage
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "256"))
+
+STEPS = 4
+
+
+@dataclass
+class ProgressEvent:
+    """
+    A progress update of the pipeline. `kind` is `start` or `done` (with the stage's wall and CPU time) once per stage,
+    and `progress` for every message in between. The CPU time is the whole process', which overlapping stages share.
+    `skipped` is set on the `done` event of a stage whose inputs were unchanged.
+    """
+    step: int
+    steps: int
+    stage: str
+    kind: str
+    message: str = ""
+    wall_seconds: Optional[float] = None
+    cpu_seconds: Optional[float] = None
+    skipped: bool = False
+
+    def __str__(self):
+        if self.kind == "start":
+            return f"Step {self.step}/{self.steps}: {self.message}"
+        if self.kind == "done" and self.skipped:
+            return f"Step {self.step}/{self.steps} ({self.stage}) skipped, nothing changed since the last run ({self.wall_seconds:.1f}s)"
+        if self.kind == "done":
+            return f"Step {self.step}/{self.steps} ({self.stage}) done in {self.wall_seconds:.1f}s ({self.cpu_seconds:.1f}s CPU)"
+        return f"    [Step {self.step}/{self.steps} - {self.stage}]: {self.message}"
+
+
+@dataclass
+class StageContext:
+    """
+    What a stage runs with. The stage fingerprints its inputs with `unchanged`, which compares them to the stage's
+    last run (`last_run`, from `pipeline_runs`), and sets `outputs` to the fingerprint of what it leaves behind.
+    """
+    conn: Optional[sqlite3.Connection]
+    db_path: str
+    progress: Callable[[str], None]
+    force: bool = False
+    run_id: Optional[int] = None
+    last_run: Optional[dict] = None
+    inputs: Optional[str] = None
+    outputs: Optional[str] = None
+
+    def unchanged(self, inputs, against="input_hash"):
+        """
+        Records the fingerprint of the stage's inputs, returning whether the stage can be skipped: the last run
+        succeeded with the same inputs (or, `against` its `output_hash`, left behind the very same state)
+        and the run isn't forced
+        """
+        self.inputs = inputs
+        if self.force or inputs is None or self.last_run is None or self.last_run["status"] not in ("ok", "skipped"):
+            return False
+        return self.last_run[against] == inputs
+
+    def skip(self, reason):
+        """
+        Skips the stage, leaving things as its last run did
+        """
+        self.outputs = self.last_run["output_hash"]
+        self.progress(f"Skipping, {reason}")
+
+
+@dataclass
+class ScreenerResult:
+    fetched: int
+    stored: int
+    stocks: list = field(repr=False)
+    skipped: bool = False
+    # Fingerprint of what the valuation reads of the stored stocks
+    outputs: Optional[str] = field(default=None, repr=False)
+
+
+@dataclass
+class ValuationResult:
+    valued: int
+    undervalued: list
+    skipped: bool = False
+
+
+@dataclass
+class NewsResult:
+    inserted: int
+    skipped: bool = False
+
+
+@dataclass
+class CrawlResult:
+    scraped: int
+    skipped_pages: int
+    skipped: bool = False
+
+
+def fingerprint(*parts):
+    """
+    Returns a digest of JSON-serializable parts, to compare the inputs and outputs of stages between runs
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def unanalyzed_articles(conn):
+    """
+    Returns the ids of the articles still waiting for their sentiment
+    """
+    return [row[0] for row in conn.execute(
+        """
+        SELECT news_clusters.article_id
+        FROM news_clusters
+        LEFT JOIN sentiments ON sentiments.article_id = news_clusters.article_id
+        WHERE sentiments.article_id IS NULL AND news_clusters.is_duplicate = 0
+        ORDER BY news_clusters.article_id
+        """
+    )]
+
+
+def screened_symbols(stocks):
+    """
+    Returns the symbols of the screened stocks to value, i.e. those above the market cap threshold
+    """
+    return sorted(
+        stock["s"] for stock in stocks
+        if (stock.get("marketCap") or 0) >= stock_valuation.MARKET_CAP_THRESHOLD
+    )
+
+
+def find_stocks(ctx: StageContext) -> ScreenerResult:
+    """
+    Screens the stocks of the sector, skipping the store when the screener returned the same stocks as last time.
+    The screener's prices and market caps move all day, so only what the valuation reads of them is compared: the
+    sector's symbols, and which of them are above the market cap threshold.
+    """
+    data = tech_stock_list_dl.fetch_screener()
+    ctx.progress(f"Total stocks fetched: {len(data)}")
+    stocks = tech_stock_list_dl.filter_sector(data, tech_stock_list_dl.SECTOR, ctx.progress)
+    screened = fingerprint(
+        tech_stock_list_dl.SECTOR,
+        stock_valuation.MARKET_CAP_THRESHOLD,
+        sorted(stock["s"] for stock in stocks),
+        screened_symbols(stocks),
+    )
+    if ctx.unchanged(screened):
+        ctx.skip("the screener returned the same stocks as last time")
+        return ScreenerResult(fetched=len(data), stored=0, stocks=stocks, skipped=True, outputs=ctx.outputs)
+
+    stored = tech_stock_list_dl.store_stocks(ctx.conn, stocks, ctx.progress)
+    ctx.outputs = screened
+    return ScreenerResult(fetched=len(data), stored=stored, stocks=stocks, outputs=ctx.outputs)
+
+
+def valuation_inputs(ctx: StageContext, screener: ScreenerResult):
+    """
+    Fingerprints what the valuation depends on: the screened stocks, the valuation settings and the fundamentals
+    snapshot of the stocks to value, i.e. their fresh cached payloads (and which ones have none)
+    """
+    tickers = screened_symbols(screener.stocks)
+    cached = load_cached_info(ctx.conn, tickers)
+    return fingerprint(
+        screener.outputs,
+        stock_valuation.MARKET_CAP_THRESHOLD,
+        stock_valuation.RISK_FREE_RATE,
+        stock_valuation.MARKET_RETURN,
+        cached,
+        sorted(set(tickers) - set(cached)),
+    )
+
+
+def undervalued_symbols(conn):
+    return sorted(row[0] for row in conn.execute("SELECT symbol FROM tech_stocks WHERE valuation = 'undervalued'"))
+
+
+def evaluate_stocks(ctx: StageContext, screener: ScreenerResult, undervalued: queue.Queue, valued: Future) -> ValuationResult:
+    """
+    Values the screened stocks, putting every provisionally undervalued ticker on `undervalued` as soon as its
+    fundamentals are in (the caller puts the end marker). `valued` is resolved as soon as the stage knows whether
+    it is skipped: with the undervalued symbols if it is, or `None` if they are still to be found.
+    """
+    inputs = valuation_inputs(ctx, screener)
+    # Storing the screened stocks reset their valuations, so they are only left as they are if nothing was stored
+    skip = ctx.unchanged(inputs) and screener.skipped
+    if skip:
+        ctx.skip("neither the screened stocks nor their fundamentals changed since the last valuation")
+        symbols = undervalued_symbols(ctx.conn)
+        valued.set_result(symbols)
+        for symbol in symbols:
+            undervalued.put(symbol)
+        valued_count = ctx.conn.execute("SELECT COUNT(*) FROM tech_stocks").fetchone()[0]
+        return ValuationResult(valued=valued_count, undervalued=symbols, skipped=True)
+
+    valued.set_result(None)
+
+    # A skipped screener left the stocks as the last valuation filtered them, so all of them are stored again
+    if screener.skipped:
+        tech_stock_list_dl.store_stocks(ctx.conn, screener.stocks, ctx.progress)
+    data = stock_valuation.run_valuation(ctx.conn, ctx.progress, on_undervalued=undervalued.put)
+    ctx.outputs = fingerprint(data.to_dict("index"))
+    return ValuationResult(valued=len(data), undervalued=data.index[data["valuation"] == "undervalued"].tolist())
+
+
+def news_inputs(symbols):
+    # Finnhub's news window is in days, so the same stocks' news is only fetched again the next day
+    return fingerprint(sorted(symbols), date.today().isoformat(), os.getenv("N_DAYS_AGO"))
+
+
+def find_news(ctx: StageContext, undervalued: queue.Queue, valued: Future, news_skipped: Future) -> NewsResult:
+    """
+    Fetches the news of the tickers taken from `undervalued` as they come. After each ticker, its new articles are
+    analyzed from their summary where possible, and the rest are queued in the crawl frontier for the spiders.
+    The news is only fetched once a day for the same undervalued stocks. When the valuation runs, they are only known
+    once it is done, so the news is fetched as they come and fingerprinted afterwards. `news_skipped` is resolved
+    with whether the stage was skipped.
+    """
+    settings = scrapy_settings()
+    from sentiment_scraper.frontier import CrawlFrontier, queue_unanalyzed
+
+    summary_min_chars = settings.getint("SUMMARY_MIN_CHARS") if settings.getbool("SCORE_SUMMARIES_FIRST") else None
+    frontier = CrawlFrontier(
+        ctx.conn,
+        f"{socket.gethostname()}-news",
+        settings.getfloat("FRONTIER_LEASE_SECONDS"),
+        settings.getint("FRONTIER_MAX_ATTEMPTS"),
+    )
+
+    async def tickers():
+        loop = asyncio.get_running_loop()
+        while (ticker := await loop.run_in_executor(None, undervalued.get)) is not None:
+            yield ticker
+        # Put the end marker back, for anyone else reading the queue
+        undervalued.put(None)
+
+    # First queue whatever earlier runs left unanalyzed, along with their failed and skipped pages
+    create_news_table(ctx.conn)
+    create_news_clusters_table(ctx.conn)
+    queue_unanalyzed(ctx.conn, frontier, summary_min_chars, ctx.progress)
+
+    symbols = valued.result()
+    skip = symbols is not None and ctx.unchanged(news_inputs(symbols))
+    news_skipped.set_result(skip)
+    if skip:
+        ctx.skip("the news of today's undervalued stocks was already fetched")
+        while undervalued.get() is not None:
+            pass
+        return NewsResult(inserted=0, skipped=True)
+
+    # Called on the thread storing the news, off the ingest's event loop
+    def on_ingested(ticker):
+        queue_unanalyzed(ctx.conn, frontier, summary_min_chars, progress=lambda message: None, requeue=False)
+
+    inserted = find_articles.run_ingest_stream(ctx.conn, tickers(), ctx.progress, on_ingested)
+    if symbols is None:
+        # The queue ends once the valuation is done, so its undervalued stocks are stored by now
+        ctx.inputs = news_inputs(undervalued_symbols(ctx.conn))
+    ctx.outputs = fingerprint(ctx.conn.execute("SELECT COUNT(*), MAX(id) FROM news").fetchone())
+    return NewsResult(inserted=inserted)
+
+
+def scrape_sentiment(ctx: StageContext, upstream_done: threading.Event, news_skipped: Future) -> CrawlResult:
+    """
+    Runs the sentiment crawl on the reactor thread, with `CRAWL_WORKERS` spiders claiming pages from the frontier side
+    by side. The spiders follow the frontier as it is fed, until `upstream_done` is set and nothing is left to claim.
+    When the news stage was skipped, the crawl is too if no article was added since it last ran.
+    """
+    from twisted.internet import defer, threads
+
+    # The fingerprint is of the articles left unanalyzed, which the last crawl left behind if nothing came in since
+    skip_news = news_skipped.result()
+    with closing(sqlite3.connect(ctx.db_path, timeout=60)) as conn:
+        pending = unanalyzed_articles(conn)
+    if ctx.unchanged(fingerprint(pending), against="output_hash") and skip_news:
+        ctx.skip(f"no article was added since the last crawl ({len(pending)} still unanalyzed)")
+        return CrawlResult(scraped=0, skipped_pages=0, skipped=True)
+
+    reactor = crawl_reactor()
+
+    @defer.inlineCallbacks
+    def crawl():
+        from scrapy.crawler import Crawler, CrawlerRunner
+        from sentiment_scraper.spiders.db_spider import DBSpider
+
+        settings = scrapy_settings()
+        runner = CrawlerRunner(settings)
+
+        # Each spider gets its share of the cores for article analysis
+        worker_settings = settings.copy()
+        worker_settings.set("ANALYSIS_WORKERS", max(1, (os.cpu_count() or 1) // CRAWL_WORKERS))
+        crawlers = [Crawler(DBSpider, worker_settings) for _ in range(CRAWL_WORKERS)]
+        host = socket.gethostname()
+        # Every crawler is waited for, then any that failed (e.g. to start) fails the stage, not to be skipped next time
+        results = yield defer.DeferredList([
+            runner.crawl(
+                crawler,
+                prepare="no",
+                worker_id=f"{host}-{worker}",
+                db_path=ctx.db_path,
+                progress=ctx.progress,
+                upstream_done=upstream_done,
+            )
+            for worker, crawler in enumerate(crawlers)
+        ], consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+        return crawlers
+
+    crawlers = threads.blockingCallFromThread(reactor, crawl)
+    with closing(sqlite3.connect(ctx.db_path, timeout=60)) as conn:
+        ctx.outputs = fingerprint(unanalyzed_articles(conn))
+    return CrawlResult(
+        scraped=sum(crawler.stats.get_value("item_scraped_count", 0) for crawler in crawlers),
+        skipped_pages=sum(crawler.stats.get_value("domain_health/skipped", 0) for crawler in crawlers),
+    )
+
+
+# The Twisted reactor can only be started once per process, so it runs for good on its own daemon thread
+_reactor = None
+_reactor_lock = threading.Lock()
+
+
+def scrapy_settings():
+    """
+    Returns the settings of the Scrapy project, making it importable first
+    """
+    if SCRAPY_PROJECT_PATH not in sys.path:
+        sys.path.insert(0, SCRAPY_PROJECT_PATH)
+    os.environ.setdefault("SCRAPY_SETTINGS_MODULE", "sentiment_scraper.settings")
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    # Scrapy must leave this process' stdout alone
+    settings.set("LOG_STDOUT", False)
+    return settings
+
+
+def crawl_reactor():
+    """
+    Returns the reactor the crawls run on, starting it (as the asyncio reactor Scrapy is configured for) on first use
+    """
+    with _reactor_lock:
+        if _reactor is not None:
+            return _reactor
+
+        started = threading.Event()
+
+        def run():
+            global _reactor
+            from twisted.internet import asyncioreactor
+
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            asyncioreactor.install(loop)
+            from twisted.internet import reactor
+
+            _reactor = reactor
+            reactor.callWhenRunning(started.set)
+            reactor.run(installSignalHandlers=False)
+
+        threading.Thread(target=run, name="crawl-reactor", daemon=True).start()
+        started.wait()
+        return _reactor
+
+
+def start_stage_run(conn, stage):
+    """
+    Records the start of a run of the stage, returning its id along with the stage's previous run (or `None`)
+    """
+    create_pipeline_runs_table(conn)
+    row = conn.execute(
+        "SELECT id, status, input_hash, output_hash FROM pipeline_runs WHERE stage = ? ORDER BY id DESC LIMIT 1",
+        (stage,),
+    ).fetchone()
+    last_run = None if row is None else dict(zip(("id", "status", "input_hash", "output_hash"), row))
+    with conn:
+        run_id = conn.execute(
+            "INSERT INTO pipeline_runs (stage, status, started_at) VALUES (?, 'running', ?)",
+            (stage, time.time()),
+        ).lastrowid
+    return run_id, last_run
+
+
+def finish_stage_run(conn, run_id, status, inputs=None, outputs=None, summary=None):
+    with conn:
+        conn.execute(
+            """
+            UPDATE pipeline_runs SET status = ?, input_hash = ?, output_hash = ?, summary = ?, finished_at = ?
+            WHERE id = ?
+            """,
+            (status, inputs, outputs, summary, time.time(), run_id),
+        )
+
+
+class PipelineWorker:
+    """
+    Runs the pipeline stages on one long-lived thread, which owns the shared SQLite connection
+    """
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline")
+        self.conn = None
+
+    async def run(self, force=False):
+        """
+        Runs every stage, yielding their progress events as they happen. With `force`, no stage is skipped.
+        """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def emit(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        run = loop.run_in_executor(self.executor, self.run_stages, emit, force)
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield event
+
+        # Raise whatever made the stages stop
+        await run
+
+    def run_stages(self, emit, force):
+        try:
+            with open(f"{self.db_path}.pipeline.lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    message = "Another process is running the pipeline, waiting for it to finish"
+                    emit(ProgressEvent(1, STEPS, "Waiting", "progress", message))
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                # The lock is released when the file is closed
+                self.run_locked_stages(emit, force)
+        finally:
+            emit(None)
+
+    def run_locked_stages(self, emit, force):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, timeout=60)
+
+        screener = self.run_stage(emit, self.conn, force, 1, "Finding Stocks", "Finding stocks", find_stocks)
+
+        # The rest run side by side, connected by the queue of undervalued tickers and the crawl frontier.
+        # Each learns what the stage before it decided through a future, to tell whether its own inputs changed.
+        undervalued = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        upstream_done = threading.Event()
+        valued = Future()
+        news_skipped = Future()
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="pipeline-stream") as streams:
+            crawl = streams.submit(
+                self.run_stage, emit, None, force, 4, "Scraping", "Scraping & analyzing articles", scrape_sentiment,
+                upstream_done, news_skipped,
+            )
+            news = streams.submit(self.run_news, emit, force, undervalued, upstream_done, valued, news_skipped)
+            try:
+                self.run_stage(
+                    emit, self.conn, force, 2, "Stock Valuation", "Running stock evaluation", evaluate_stocks,
+                    screener, undervalued, valued,
+                )
+            finally:
+                # However the valuation ended, the news stage must not wait on it forever
+                if not valued.done():
+                    valued.set_result(None)
+                undervalued.put(None)
+            news.result()
+            crawl.result()
+
+    def run_news(self, emit, force, undervalued, upstream_done, valued, news_skipped):
+        # SQLite connections can't be shared across threads, so the news stage has its own. It stores the news from a
+        # writer thread of its own (see `find_articles.ingest_news`), one thread at a time.
+        conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        try:
+            return self.run_stage(
+                emit, conn, force, 3, "Find Articles", "Finding news articles", find_news, undervalued, valued, news_skipped
+            )
+        except BaseException:
+            # Keep taking tickers until the valuation is done, so it never blocks on a full queue
+            while undervalued.get() is not None:
+                pass
+            raise
+        finally:
+            conn.close()
+            if not news_skipped.done():
+                news_skipped.set_result(False)
+            upstream_done.set()
+
+    def run_stage(self, emit, conn, force, step, stage, title, function, *inputs):
+        """
+        Runs one stage, recording the run in `pipeline_runs` under the stage function's name
+        """
+        def progress(message):
+            emit(ProgressEvent(step, STEPS, stage, "progress", message))
+
+        emit(ProgressEvent(step, STEPS, stage, "start", title))
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        # The connection the stage was given may belong to another thread (or be None), so the runs get their own
+        with closing(sqlite3.connect(self.db_path, timeout=60)) as runs:
+            run_id, last_run = start_stage_run(runs, function.__name__)
+        ctx = StageContext(conn, self.db_path, progress, force=force, run_id=run_id, last_run=last_run)
+        try:
+            result = function(ctx, *inputs)
+        except BaseException:
+            with closing(sqlite3.connect(self.db_path, timeout=60)) as runs:
+                finish_stage_run(runs, run_id, "failed", ctx.inputs)
+            raise
+        with closing(sqlite3.connect(self.db_path, timeout=60)) as runs:
+            finish_stage_run(runs, run_id, "skipped" if result.skipped else "ok", ctx.inputs, ctx.outputs, repr(result))
+
+        # CPU time is the whole process' (including the crawl's reactor thread), not that of the analysis pools
+        emit(ProgressEvent(
+            step,
+            STEPS,
+            stage,
+            "done",
+            f"{result}",
+            wall_seconds=time.perf_counter() - wall_start,
+            cpu_seconds=time.process_time() - cpu_start,
+            skipped=result.skipped,
+        ))
+        return result
+
+
+_worker = None
+
+
+def get_worker():
+    global _worker
+    if _worker is None:
+        _worker = PipelineWorker(os.getenv("DB_PATH"))
+    return _worker
+
+
+async def run_pipeline(force=False):
+    """
+    Runs the whole pipeline on the shared worker, yielding its `ProgressEvent`s.
+    Stages whose inputs didn't change since they last succeeded are skipped, unless `force` is set.
+    """
+    async for event in get_worker().run(force):
+        yield event
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the whole workflow in-process")
+    parser.add_argument("--force", action="store_true", help="Run every stage, even those whose inputs are unchanged")
+    args = parser.parse_args()
+
+    async def main():
+        async for event in run_pipeline(args.force):
+            print(event, flush=True)
+
+    asyncio.run(main())
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Make the shared stock-bot modules (e.g. db_schema) importable from the crawler
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
@@ -0,0 +1,74 @@
+# CPU-bound article analysis, run in worker processes by ArticleAnalysisPipeline
+
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+from sentiment_scraper.article_store import ArticleStore
+from sentiment_scraper.extract import extract_text
+
+# Set once per worker process by init_worker, so the VADER lexicon is only loaded once
+analyzer = None
+store = None
+
+
+def init_worker(store_root=None):
+    global analyzer, store
+    analyzer = SentimentIntensityAnalyzer()
+    store = ArticleStore(store_root) if store_root else None
+
+
+def interpret_sentiment(compound_score):
+    if compound_score >= 0.05:
+        return "positive"
+    elif compound_score <= -0.05:
+        return "negative"
+    else:
+        return "neutral"
+
+
+def score_text(text):
+    """
+    Scores the text, returning the VADER scores and the overall sentiment
+    """
+    if analyzer is None:
+        init_worker()
+
+    scores = analyzer.polarity_scores(text)
+    scores["overall_sentiment"] = interpret_sentiment(scores["compound"])
+    return scores
+
+
+def score_summary(summary, min_chars):
+    """
+    Scores an article's summary, or returns `None` if it is missing, shorter than `min_chars` or neutral.
+    Those are too thin or ambiguous to go by, so the full page has to be scraped instead.
+    """
+    if summary is None or len(summary.strip()) < min_chars:
+        return None
+
+    scores = score_text(summary)
+    if scores["overall_sentiment"] == "neutral":
+        return None
+    return scores
+
+
+def analyze_article(url, html, store_key=None):
+    """
+    Extracts the article text from the page and scores it. The text is kept in the article store under `store_key`.
+    The length of the extracted text is returned along with the scores as `text_chars`.
+    """
+    text = extract_text(url, html)
+    if store is not None and store_key is not None:
+        store.put(store_key, text)
+    scores = score_text(text)
+    scores["text_chars"] = len(text)
+    return scores
+
+
+def rescore_article(store_key):
+    """
+    Scores the stored text of an article, or returns `None` if it was never stored
+    """
+    text = store.get(store_key)
+    if text is None:
+        return None
+    return score_text(text)
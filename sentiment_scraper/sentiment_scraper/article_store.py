@@ -0,0 +1,46 @@
+# On-disk store of extracted article text, so sentiment can be re-scored without crawling again
+
+import hashlib
+import os
+import zlib
+
+
+def default_store_path(db_path):
+    """
+    The store lives next to the SQLite database, unless ARTICLE_STORE_PATH says otherwise
+    """
+    return os.getenv("ARTICLE_STORE_PATH") or os.path.join(os.path.dirname(db_path), "articles")
+
+
+class ArticleStore:
+    """
+    Content-addressed store of article text, keyed by the hash of the article URL.
+    Each text is zlib-compressed into `<root>/<first 2 hex chars>/<sha256 of url>.z`.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, url):
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], f"{digest}.z")
+
+    def __contains__(self, url):
+        return os.path.exists(self.path_for(url))
+
+    def put(self, url, text):
+        path = self.path_for(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so a crash never leaves a truncated entry behind
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(text.encode("utf-8"), 6))
+        os.replace(tmp_path, path)
+
+    def get(self, url):
+        try:
+            with open(self.path_for(url), "rb") as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,72 @@
+# Runs the sentiment crawl as several db_spider processes sharing the crawl frontier
+#
+# Run from the sentiment_scraper directory:
+#     python -m sentiment_scraper.crawl_workers [--workers N]
+#
+# More workers can join from other shells (or restart after a crash) with:
+#     scrapy crawl db_spider -a prepare=no -a worker_id=<unique id>
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+
+def stream_output(proc, prefix):
+    for line in proc.stdout:
+        print(f"{prefix}{line.rstrip()}", flush=True)
+
+
+def run_workers(workers):
+    """
+    Brings the frontier up to date once, then crawls it with `workers` spider processes, returning whether they all
+    succeeded. Each worker gets its share of the cores for article analysis.
+    """
+    scrapy = [sys.executable, "-m", "scrapy", "crawl", "db_spider"]
+    host = socket.gethostname()
+
+    # Clustering, fan-out and summary scoring only need to happen once, before anyone claims pages
+    if subprocess.run(scrapy + ["-a", "prepare=only", "-a", f"worker_id={host}-prepare"]).returncode != 0:
+        return False
+
+    analysis_workers = max(1, (os.cpu_count() or 1) // workers)
+    procs = []
+    threads = []
+    for worker in range(workers):
+        proc = subprocess.Popen(
+            scrapy + [
+                "-a", "prepare=no",
+                "-a", f"worker_id={host}-{worker}",
+                "-s", f"ANALYSIS_WORKERS={analysis_workers}",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        thread = threading.Thread(target=stream_output, args=(proc, f"[worker {worker}] "), daemon=True)
+        thread.start()
+        procs.append(proc)
+        threads.append(thread)
+
+    codes = [proc.wait() for proc in procs]
+    for thread in threads:
+        thread.join()
+    return all(code == 0 for code in codes)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Crawls the pending articles with several spider processes")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("CRAWL_WORKERS", "4")),
+        help="Number of spider processes (default: CRAWL_WORKERS, or 4)",
+    )
+    args = parser.parse_args()
+
+    sys.exit(0 if run_workers(args.workers) else 1)
@@ -0,0 +1,93 @@
+# Fast article text extraction with lxml, falling back to newspaper3k when it finds too little text
+
+from urllib.parse import urlsplit
+
+import lxml.html
+from lxml.etree import ParserError
+from newspaper import Article
+
+# Pages whose fast-path text is shorter than this are handed to newspaper3k instead
+MIN_FAST_TEXT_CHARS = 400
+
+# Paragraphs shorter than this are treated as boilerplate (bylines, captions, share buttons, ...)
+MIN_PARAGRAPH_CHARS = 40
+
+# XPath of the article body paragraphs, for the publishers Finnhub most often links to
+DOMAIN_PROFILES = {
+    "finance.yahoo.com": "//div[contains(@class, 'caas-body') or contains(@class, 'body yf-')]//p",
+    "www.benzinga.com": "//div[@id='article-body' or contains(@class, 'article-content-body')]//p",
+    "seekingalpha.com": "//div[@data-test-id='content-container']//p",
+    "www.marketwatch.com": "//div[contains(@class, 'article__body')]//p",
+    "www.fool.com": "//div[contains(@class, 'article-body')]//p",
+    "www.reuters.com": "//div[starts-with(@data-testid, 'paragraph-')]",
+    "www.cnbc.com": "//div[contains(@class, 'ArticleBody-articleBody')]//p",
+    "www.zacks.com": "//div[@id='comtext' or contains(@class, 'commentary_body')]//p",
+    "www.investors.com": "//div[contains(@class, 'single-post-content')]//p",
+    "www.businessinsider.com": "//div[contains(@class, 'content-lock-content')]//p",
+}
+
+# Elements that never hold article text
+BOILERPLATE_TAGS = ["script", "style", "noscript", "nav", "header", "footer", "aside", "form", "figure", "iframe"]
+
+
+def domain_of(url):
+    return urlsplit(url).netloc.lower()
+
+
+def paragraphs_text(paragraphs):
+    texts = [" ".join(p.text_content().split()) for p in paragraphs]
+    return "\n\n".join(text for text in texts if len(text) >= MIN_PARAGRAPH_CHARS)
+
+
+def densest_block_text(tree):
+    """
+    Generic heuristic: the article body is the element whose direct `<p>` children hold the most text
+    """
+    best_text = ""
+    best_length = 0
+    for parent in {p.getparent() for p in tree.iter("p") if p.getparent() is not None}:
+        text = paragraphs_text(parent.findall("p"))
+        if len(text) > best_length:
+            best_text = text
+            best_length = len(text)
+    return best_text
+
+
+def fast_extract_text(url, html):
+    """
+    Extracts the article text with lxml alone: the publisher's profile if there is one, the paragraph-density
+    heuristic otherwise. Returns an empty string if the page can't be parsed.
+    """
+    try:
+        tree = lxml.html.fromstring(html)
+    except (ParserError, ValueError):
+        return ""
+
+    for element in list(tree.iter(*BOILERPLATE_TAGS)):
+        element.drop_tree()
+
+    profile = DOMAIN_PROFILES.get(domain_of(url))
+    if profile is not None:
+        text = paragraphs_text(tree.xpath(profile))
+        if len(text) >= MIN_FAST_TEXT_CHARS:
+            return text
+
+    return densest_block_text(tree)
+
+
+def newspaper_extract_text(url, html):
+    # Extract main content using newspaper3k
+    article = Article(url)
+    article.set_html(html)
+    article.parse()
+    return article.text
+
+
+def extract_text(url, html):
+    """
+    Extracts the article text, only falling back to newspaper3k when the fast path yields too little text
+    """
+    text = fast_extract_text(url, html)
+    if len(text) >= MIN_FAST_TEXT_CHARS:
+        return text
+    return newspaper_extract_text(url, html)
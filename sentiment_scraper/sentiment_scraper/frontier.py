@@ -0,0 +1,266 @@
+# The crawl frontier shared by every db_spider worker, as a lease-based queue in the crawl_frontier table
+
+import time
+
+from db_schema import create_crawl_frontier_table, create_ticker_sentiment_table
+from sentiment_scraper.analysis import score_summary
+
+# Rows that can be claimed: pending ones, and those whose lease ran out with attempts left. Taking a page back from an
+# expired lease uses up an attempt, since its worker may have died on the page itself.
+CLAIMABLE = """
+    state = 'pending'
+    OR (state = 'in_flight' AND COALESCE(lease_expires, 0) < :now AND attempts + 1 < :max_attempts)
+"""
+
+
+class CrawlFrontier:
+    """
+    Hands out disjoint batches of pages to crawl to any number of workers sharing the database.
+    A claimed page is leased to its worker for `lease_seconds`, and the worker keeps renewing the lease while it runs.
+    If the worker dies, its lease runs out and the page is claimed by another one.
+    """
+
+    def __init__(self, conn, worker_id, lease_seconds, max_attempts):
+        self.conn = conn
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        create_crawl_frontier_table(conn)
+
+    def sync(self, requeue=True):
+        """
+        Brings the frontier up to date with the articles that still need their page scraped. With `requeue`, failed
+        pages with attempts left and skipped pages are queued again, which is done once per crawl, before the workers
+        start claiming. Without it, only new articles are added, so a frontier can be fed while it is being crawled.
+        """
+        with self.conn:
+            # Articles analyzed in the meantime (fanned out, scored from their summary or re-scored) are done
+            self.conn.execute(
+                """
+                UPDATE crawl_frontier SET state = 'done', lease_owner = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE state != 'done' AND article_id IN (SELECT article_id FROM sentiments)
+                """
+            )
+            if requeue:
+                self.conn.execute(
+                    """
+                    UPDATE crawl_frontier SET state = 'pending', updated_at = CURRENT_TIMESTAMP
+                    WHERE state = 'skipped' OR (state = 'failed' AND attempts < ?)
+                    """,
+                    (self.max_attempts,),
+                )
+
+            # Syndicated copies of a story the ticker already has are left out entirely
+            self.conn.execute(
+                """
+                INSERT OR IGNORE INTO crawl_frontier (article_id, crawl_key)
+                SELECT news_clusters.article_id, news_clusters.crawl_key
+                FROM news_clusters
+                LEFT JOIN sentiments ON sentiments.article_id = news_clusters.article_id
+                WHERE sentiments.article_id IS NULL AND news_clusters.is_duplicate = 0
+                """
+            )
+
+    def release_own(self):
+        """
+        Puts back the pages still leased to this worker, left behind by a previous run that died. The run may have died
+        on the page itself, so this uses up an attempt: pages out of attempts are left failed.
+        """
+        with self.conn:
+            self.conn.execute(
+                """
+                UPDATE crawl_frontier
+                SET state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, attempts = attempts + 1,
+                    last_error = 'Abandoned in flight', lease_owner = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE state = 'in_flight' AND lease_owner = ?
+                """,
+                (self.max_attempts, self.worker_id),
+            )
+
+    def pending_pages(self):
+        """
+        Returns the number of pages not yet claimed by a live worker
+        """
+        return self.conn.execute(
+            f"SELECT COUNT(DISTINCT crawl_key) FROM crawl_frontier WHERE {CLAIMABLE}",
+            {"now": time.time(), "max_attempts": self.max_attempts},
+        ).fetchone()[0]
+
+    def claim(self, limit):
+        """
+        Leases up to `limit` pages to this worker, returning them as (crawl key, article ids) pairs.
+        Pending pages are claimed along with those whose lease has run out, which uses up an attempt (like
+        `release_own`); those out of attempts are failed instead.
+        `BEGIN IMMEDIATE` takes the write lock up front, so two workers can never claim the same page.
+        """
+        params = {
+            "now": time.time(),
+            "max_attempts": self.max_attempts,
+            "worker_id": self.worker_id,
+            "limit": limit,
+        }
+        params["lease_expires"] = params["now"] + self.lease_seconds
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                """
+                UPDATE crawl_frontier
+                SET state = 'failed', attempts = attempts + 1, last_error = 'Lease expired', lease_owner = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE state = 'in_flight' AND COALESCE(lease_expires, 0) < :now AND attempts + 1 >= :max_attempts
+                """,
+                params,
+            )
+            claimed = self.conn.execute(
+                f"""
+                UPDATE crawl_frontier
+                SET attempts = CASE WHEN state = 'in_flight' THEN attempts + 1 ELSE attempts END,
+                    last_error = CASE WHEN state = 'in_flight' THEN 'Lease expired' ELSE last_error END,
+                    state = 'in_flight', lease_owner = :worker_id, lease_expires = :lease_expires,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE ({CLAIMABLE})
+                  AND crawl_key IN (
+                    SELECT crawl_key FROM crawl_frontier
+                    WHERE {CLAIMABLE}
+                    GROUP BY crawl_key
+                    LIMIT :limit
+                  )
+                RETURNING crawl_key, article_id
+                """,
+                params,
+            ).fetchall()
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+        pages = {}
+        for crawl_key, article_id in claimed:
+            pages.setdefault(crawl_key, []).append(article_id)
+        return list(pages.items())
+
+    def renew(self):
+        """
+        Extends the leases of every page this worker is still crawling
+        """
+        with self.conn:
+            self.conn.execute(
+                "UPDATE crawl_frontier SET lease_expires = ? WHERE state = 'in_flight' AND lease_owner = ?",
+                (time.time() + self.lease_seconds, self.worker_id),
+            )
+
+    def skip(self, article_ids):
+        """
+        Records pages that were skipped (not tried). They are queued again by the next crawl, without using up an attempt.
+        """
+        with self.conn:
+            self.conn.executemany(
+                """
+                UPDATE crawl_frontier SET state = 'skipped', lease_owner = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE article_id = ? AND lease_owner = ?
+                """,
+                [(article_id, self.worker_id) for article_id in article_ids],
+            )
+
+    def fail(self, article_ids, error):
+        """
+        Records a failed attempt at the articles' page. They are retried by the next crawl, up to `max_attempts` times.
+        """
+        with self.conn:
+            self.conn.executemany(
+                """
+                UPDATE crawl_frontier
+                SET state = 'failed', attempts = attempts + 1, last_error = ?, lease_owner = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE article_id = ? AND lease_owner = ?
+                """,
+                [(error, article_id, self.worker_id) for article_id in article_ids],
+            )
+
+
+def fan_out_known_sentiments(conn):
+    """
+    Copies the sentiment of scraped articles to the unanalyzed ones with the same crawl key (the same page, or a
+    near-duplicate of it), returning how many
+    """
+    cursor = conn.execute(
+        """
+        INSERT OR IGNORE INTO sentiments (article_id, url, score_neg, score_neu, score_pos, score_compound, overall_sentiment)
+        SELECT pending.article_id, known.url, known.score_neg, known.score_neu, known.score_pos, known.score_compound, known.overall_sentiment
+        FROM news_clusters AS pending
+        LEFT JOIN sentiments AS pending_sentiment ON pending_sentiment.article_id = pending.article_id
+        JOIN news_clusters AS analyzed ON analyzed.crawl_key = pending.crawl_key AND analyzed.article_id != pending.article_id
+        JOIN sentiments AS known ON known.article_id = analyzed.article_id AND known.source = 'page'
+        WHERE pending_sentiment.article_id IS NULL AND pending.is_duplicate = 0
+        GROUP BY pending.article_id
+        """
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def score_summaries(conn, min_chars):
+    """
+    Scores the unanalyzed articles from their Finnhub summary, returning how many were scored.
+    Articles whose summary is missing, too short or neutral are left for the crawl. Articles already queued for the
+    crawl had their summary judged before, so they are not scored again.
+    """
+    create_crawl_frontier_table(conn)
+    pending = conn.execute(
+        """
+        SELECT news.id, news.url, news.summary
+        FROM news
+        JOIN news_clusters ON news_clusters.article_id = news.id
+        LEFT JOIN sentiments ON sentiments.article_id = news.id
+        LEFT JOIN crawl_frontier ON crawl_frontier.article_id = news.id
+        WHERE sentiments.article_id IS NULL AND crawl_frontier.article_id IS NULL AND news_clusters.is_duplicate = 0
+        """
+    ).fetchall()
+
+    rows = []
+    for article_id, url, summary in pending:
+        scores = score_summary(summary, min_chars)
+        if scores is None:
+            continue
+        rows.append((
+            article_id,
+            url,
+            scores["neg"],
+            scores["neu"],
+            scores["pos"],
+            scores["compound"],
+            scores["overall_sentiment"],
+        ))
+
+    with conn:
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO sentiments (article_id, url, score_neg, score_neu, score_pos, score_compound, overall_sentiment, source)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'summary')
+            """,
+            rows,
+        )
+    return len(rows)
+
+
+def queue_unanalyzed(conn, frontier, summary_min_chars=None, progress=print, requeue=True):
+    """
+    Analyzes whatever can be analyzed without crawling, then queues the rest in the crawl frontier.
+    Summaries are only scored when `summary_min_chars` is given. The articles must already be clustered.
+    `requeue` is passed on to `CrawlFrontier.sync`.
+    """
+    # Create the sentiments table, along with the per-ticker aggregate that is maintained as sentiments are inserted
+    create_ticker_sentiment_table(conn)
+
+    # Articles whose cluster's page was already analyzed get its sentiment without being fetched again
+    fanned_out = fan_out_known_sentiments(conn)
+    progress(f"Copied the sentiment of {fanned_out} articles from already analyzed pages")
+
+    # Articles with a clear-cut summary are scored from it, so only the rest have to be scraped
+    if summary_min_chars is not None:
+        scored = score_summaries(conn, summary_min_chars)
+        progress(f"Scored {scored} articles from their summary")
+
+    # Queue the articles that still need their page scraped
+    frontier.sync(requeue)
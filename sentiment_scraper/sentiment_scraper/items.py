@@ -6,7 +6,25 @@
 import scrapy
 
 
-class SentimentScraperItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+class ArticleItem(scrapy.Item):
+    # A downloaded article page, still to be analyzed by ArticleAnalysisPipeline
+    article_ids = scrapy.Field()  # Every news row linking to the page
+    url = scrapy.Field()
+    html = scrapy.Field()
+    store_key = scrapy.Field()  # The news_clusters.crawl_key the page was requested from, used as the key of the article store
+
+    def __repr__(self):
+        # The page's HTML is left out, not to flood the log (e.g. when the item is dropped)
+        return repr({key: value for key, value in self.items() if key != "html"})
+
+
+class SentimentItem(scrapy.Item):
+    # The VADER scores of one page, stored in the sentiments table for every news row linking to it
+    article_ids = scrapy.Field()
+    url = scrapy.Field()
+    score_neg = scrapy.Field()
+    score_neu = scrapy.Field()
+    score_pos = scrapy.Field()
+    score_compound = scrapy.Field()
+    overall_sentiment = scrapy.Field()
+    text_chars = scrapy.Field()  # Length of the extracted article text, used by DomainHealthMiddleware
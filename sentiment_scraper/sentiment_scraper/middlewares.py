@@ -3,7 +3,16 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import json
+import sqlite3
+import statistics
+import time
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest
+from scrapy.utils.httpobj import urlparse_cached
+
+from db_schema import create_domain_stats_table
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -101,3 +110,199 @@ class SentimentScraperDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+# Number of recent download latencies kept per domain for its median
+LATENCY_SAMPLES = 25
+
+# Stats that are added up over every crawl (and every worker)
+DOMAIN_COUNTERS = ["requests", "successes", "extracted", "bytes"]
+
+
+class DomainHealthMiddleware:
+    """
+    Learns which publisher domains are worth crawling. Every response (and failure) updates the domain's stats in
+    `domain_stats`: requests, successful responses, responses that yielded article text, bytes and latency.
+
+    From those stats, before anything is downloaded:
+    - Domains that rarely yield any text (paywalls, robots.txt bans, dead sites) are skipped, apart from one probe
+      request every `DOMAIN_PROBE_HOURS`. A successful probe resets the domain's stats.
+    - The download timeout is a few times the domain's median latency, and the size cap a few times its average page.
+    - Slow or flaky domains get fewer concurrent requests.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        settings = crawler.settings
+        self.min_requests = settings.getint("DOMAIN_MIN_REQUESTS")
+        self.min_yield = settings.getfloat("DOMAIN_MIN_YIELD")
+        self.probe_seconds = settings.getfloat("DOMAIN_PROBE_HOURS") * 3600
+        self.min_text_chars = settings.getint("DOMAIN_MIN_TEXT_CHARS")
+        self.max_timeout = settings.getfloat("DOWNLOAD_TIMEOUT")
+        self.max_size = settings.getint("DOWNLOAD_MAXSIZE")
+        self.domain_concurrency = settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN")
+        self.stats = {}
+        # The counters as loaded from domain_stats, so only this crawl's increments are added back when it closes.
+        # Other workers may be updating the same domains in the meantime. Set to None when a domain's stats are reset.
+        self.baseline = {}
+        self.conn = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(middleware.item_scraped, signal=signals.item_scraped)
+        return middleware
+
+    def spider_opened(self, spider):
+        self.conn = sqlite3.connect(spider.db_path, timeout=60)
+        create_domain_stats_table(self.conn)
+        self.conn.row_factory = sqlite3.Row
+        for row in self.conn.execute("SELECT * FROM domain_stats"):
+            domain_stats = dict(row)
+            domain_stats["latency_samples"] = json.loads(domain_stats["latency_samples"])
+            self.stats[row["domain"]] = domain_stats
+            self.baseline[row["domain"]] = {counter: row[counter] for counter in DOMAIN_COUNTERS}
+
+        # The downloader reads the concurrency of a domain's slot from DOWNLOAD_SLOTS when the slot is created
+        slots = self.crawler.engine.downloader.per_slot_settings
+        for domain, domain_stats in self.stats.items():
+            slots.setdefault(domain, {}).setdefault("concurrency", self.concurrency(domain_stats))
+
+    def request_domain(self, request):
+        # The downloader's slot key, which the concurrency seeded into its per-slot settings must match
+        return urlparse_cached(request).hostname or ""
+
+    def domain_stats(self, domain):
+        if domain not in self.stats:
+            self.stats[domain] = {
+                "domain": domain,
+                "requests": 0,
+                "successes": 0,
+                "extracted": 0,
+                "bytes": 0,
+                "latency_samples": [],
+                "median_latency": None,
+                "last_request_at": None,
+                "last_success_at": None,
+            }
+            self.baseline[domain] = {counter: 0 for counter in DOMAIN_COUNTERS}
+        return self.stats[domain]
+
+    def is_dead(self, domain_stats):
+        return (
+            domain_stats["requests"] >= self.min_requests
+            and domain_stats["extracted"] / domain_stats["requests"] < self.min_yield
+        )
+
+    def concurrency(self, domain_stats):
+        if domain_stats["requests"] == 0:
+            return self.domain_concurrency
+        # Scale down with the domain's yield, and send slow domains one request at a time
+        concurrency = max(1, round(self.domain_concurrency * domain_stats["extracted"] / domain_stats["requests"]))
+        if domain_stats["median_latency"] is not None and domain_stats["median_latency"] > self.max_timeout / 4:
+            concurrency = 1
+        return concurrency
+
+    def process_request(self, request, spider):
+        domain = self.request_domain(request)
+        domain_stats = self.domain_stats(domain)
+        now = time.time()
+
+        if self.is_dead(domain_stats):
+            last_request_at = domain_stats["last_request_at"] or 0
+            if now - last_request_at < self.probe_seconds:
+                self.crawler.stats.inc_value("domain_health/skipped")
+                request.meta["domain_skipped"] = True
+                raise IgnoreRequest(f"Skipping {request.url}, {domain} rarely yields any article text")
+            spider.logger.info(f"Probing {domain}, which has been skipped for the past {self.probe_seconds / 3600:.0f} hours")
+            request.meta["domain_probe"] = True
+
+        domain_stats["last_request_at"] = now
+
+        # Give up on pages taking several times longer, or being several times larger, than the domain's usual page
+        if domain_stats["median_latency"] is not None:
+            request.meta.setdefault("download_timeout", min(self.max_timeout, max(5.0, domain_stats["median_latency"] * 4)))
+        if domain_stats["successes"] > 0:
+            average_size = domain_stats["bytes"] / domain_stats["successes"]
+            request.meta.setdefault("download_maxsize", min(self.max_size, max(1024 * 1024, int(average_size * 4))))
+        return None
+
+    def process_response(self, request, response, spider):
+        # robots.txt fetches say nothing about the domain's articles
+        if request.meta.get("dont_obey_robotstxt"):
+            return response
+
+        domain_stats = self.domain_stats(self.request_domain(request))
+        domain_stats["requests"] += 1
+        if "download_latency" in request.meta:
+            samples = (domain_stats["latency_samples"] + [request.meta["download_latency"]])[-LATENCY_SAMPLES:]
+            domain_stats["latency_samples"] = samples
+            domain_stats["median_latency"] = statistics.median(samples)
+        if response.status == 200:
+            domain_stats["successes"] += 1
+            domain_stats["bytes"] += len(response.body)
+            domain_stats["last_success_at"] = time.time()
+        return response
+
+    def process_exception(self, request, exception, spider):
+        # Our own skips aren't failures, but timeouts, oversized pages and robots.txt bans are
+        if request.meta.get("domain_skipped") or request.meta.get("dont_obey_robotstxt"):
+            return None
+        self.domain_stats(self.request_domain(request))["requests"] += 1
+        return None
+
+    def item_scraped(self, item, response, spider):
+        text_chars = item.get("text_chars")
+        if text_chars is None or text_chars < self.min_text_chars:
+            return
+
+        # Credited to the request the response answers, like its success in process_response
+        domain_stats = self.domain_stats(self.request_domain(response.request))
+        if response.request.meta.get("domain_probe"):
+            # The domain is back, so start counting from scratch
+            domain_stats.update(requests=1, successes=1, extracted=0, bytes=len(response.body))
+            self.baseline[domain_stats["domain"]] = None
+        domain_stats["extracted"] += 1
+
+    def spider_closed(self, spider):
+        if self.conn is None:
+            return
+
+        # Reset domains overwrite their counters, the rest add this crawl's increments to them
+        columns = ["domain"] + DOMAIN_COUNTERS + ["latency_samples", "median_latency", "last_request_at", "last_success_at"]
+        added, overwritten = [], []
+        for domain, domain_stats in self.stats.items():
+            row = dict(domain_stats, latency_samples=json.dumps(domain_stats["latency_samples"]))
+            baseline = self.baseline[domain]
+            if baseline is None:
+                overwritten.append(tuple(row[column] for column in columns))
+            else:
+                row.update({counter: domain_stats[counter] - baseline[counter] for counter in DOMAIN_COUNTERS})
+                added.append(tuple(row[column] for column in columns))
+
+        insert_query = f"INSERT INTO domain_stats ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        latest = ", ".join(f"{column} = excluded.{column}" for column in columns[len(DOMAIN_COUNTERS) + 1:])
+        with self.conn:
+            self.conn.executemany(
+                f"""
+                {insert_query}
+                ON CONFLICT (domain) DO UPDATE SET
+                    {', '.join(f"{counter} = {counter} + excluded.{counter}" for counter in DOMAIN_COUNTERS)}, {latest}
+                """,
+                added,
+            )
+            self.conn.executemany(
+                f"""
+                {insert_query}
+                ON CONFLICT (domain) DO UPDATE SET
+                    {', '.join(f"{counter} = excluded.{counter}" for counter in DOMAIN_COUNTERS)}, {latest}
+                """,
+                overwritten,
+            )
+        self.conn.close()
+        self.conn = None
+
+        skipped = self.crawler.stats.get_value("domain_health/skipped", 0)
+        spider.logger.info(f"Skipped {skipped} pages on domains that rarely yield any article text")
@@ -3,11 +3,159 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import asyncio
+import multiprocessing
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy import signals
+from scrapy.exceptions import DropItem
+from twisted.internet import defer, task
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 
+from db_schema import create_crawl_frontier_table, create_ticker_sentiment_table
+from sentiment_scraper.analysis import analyze_article, init_worker
+from sentiment_scraper.article_store import default_store_path
+from sentiment_scraper.items import ArticleItem, SentimentItem
+
+SENTIMENT_COLUMNS = [
+    "article_id",
+    "url",
+    "score_neg",
+    "score_neu",
+    "score_pos",
+    "score_compound",
+    "overall_sentiment",
+]
+
+
+class ArticleAnalysisPipeline:
+    """
+    Turns downloaded `ArticleItem`s into `SentimentItem`s. Text extraction and VADER scoring are CPU-bound, so they run
+    in a pool of worker processes (each loading the analyzer once) and come back as deferreds. The reactor thread stays
+    free to keep downloading while articles are being analyzed.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint("ANALYSIS_WORKERS") or None)
+
+    def open_spider(self, spider):
+        # The extracted text is also kept in the article store, so it can be re-scored later without crawling
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(default_store_path(spider.db_path),),
+        )
+
+    def process_item(self, item, spider):
+        if not isinstance(item, ArticleItem):
+            return item
+
+        future = self.pool.submit(analyze_article, item["url"], item["html"], item["store_key"])
+        d = defer.Deferred.fromFuture(asyncio.wrap_future(future))
+        d.addCallback(self.to_sentiment_item, item)
+        d.addErrback(self.analysis_failed, item, spider)
+        return d
+
+    def analysis_failed(self, failure, item, spider):
+        # The page's articles use up an attempt in the crawl frontier, instead of being left in flight
+        spider.frontier.fail(item["article_ids"], repr(failure.value))
+        raise DropItem(f"Analysis failed: {failure.value!r}")
+
+    def to_sentiment_item(self, scores, item):
+        return SentimentItem(
+            article_ids=item["article_ids"],
+            url=item["url"],
+            score_neg=scores["neg"],
+            score_neu=scores["neu"],
+            score_pos=scores["pos"],
+            score_compound=scores["compound"],
+            overall_sentiment=scores["overall_sentiment"],
+            text_chars=scores["text_chars"],
+        )
+
+    def close_spider(self, spider):
+        self.pool.shutdown()
+
 
 class SentimentScraperPipeline:
+    """
+    Writes the sentiment items to the database over a single WAL-mode connection.
+    Rows are buffered and written with `executemany` in group commits, every `SENTIMENT_BATCH_SIZE` rows or
+    `SENTIMENT_FLUSH_SECONDS` seconds, whichever comes first. Whatever is left is flushed when the spider closes.
+    """
+
+    def __init__(self, batch_size, flush_seconds):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.conn = None
+        self.flush_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(
+            crawler.settings.getint("SENTIMENT_BATCH_SIZE"),
+            crawler.settings.getfloat("SENTIMENT_FLUSH_SECONDS"),
+        )
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.conn = sqlite3.connect(spider.db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        create_ticker_sentiment_table(self.conn)
+        create_crawl_frontier_table(self.conn)
+
+        # Flush periodically, so rows don't sit in the buffer while the crawl is slow
+        self.flush_loop = task.LoopingCall(self.flush)
+        self.flush_loop.start(self.flush_seconds, now=False)
+
     def process_item(self, item, spider):
+        # Fan the page's sentiment out to every article linking to it
+        adapter = ItemAdapter(item)
+        for article_id in adapter["article_ids"]:
+            self.buffer.append((article_id,) + tuple(adapter.get(column) for column in SENTIMENT_COLUMNS[1:]))
+
+        if len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
         return item
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+
+        # The articles are marked done in the crawl frontier in the same transaction, so a crash can't lose either
+        rows, self.buffer = self.buffer, []
+        with self.conn:
+            self.conn.executemany(
+                f"""
+                INSERT OR IGNORE INTO sentiments ({', '.join(SENTIMENT_COLUMNS)})
+                VALUES ({', '.join('?' * len(SENTIMENT_COLUMNS))})
+                """,
+                rows,
+            )
+            self.conn.executemany(
+                "UPDATE crawl_frontier SET state = 'done', lease_owner = NULL, updated_at = CURRENT_TIMESTAMP WHERE article_id = ?",
+                [(row[0],) for row in rows],
+            )
+
+    def spider_closed(self, spider):
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
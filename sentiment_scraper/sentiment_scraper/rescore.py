@@ -0,0 +1,102 @@
+# Re-scores stored article text without crawling anything
+#
+# Run from the sentiment_scraper directory:
+#     python -m sentiment_scraper.rescore [--missing-only] [--workers N]
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+from db_schema import create_news_clusters_table, create_news_table, create_ticker_sentiment_table
+from news_dedupe import NewsClusterer
+from sentiment_scraper.analysis import init_worker, rescore_article
+from sentiment_scraper.article_store import default_store_path
+from sentiment_scraper.pipelines import SENTIMENT_COLUMNS
+
+BATCH_SIZE = 500
+
+
+def rescore(db_path, missing_only=False, workers=None):
+    """
+    Streams the stored text of every article through the analyzer in parallel, upserting the new scores into
+    `sentiments`. With `missing_only`, only articles without a sentiments row are scored.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    create_ticker_sentiment_table(conn)
+
+    create_news_table(conn)
+    create_news_clusters_table(conn)
+    NewsClusterer(conn).cluster_pending()
+
+    # The article store is keyed by crawl key, and syndicated copies are not scored.
+    # Articles scored from their summary never had their page stored, so they are left alone.
+    query = """
+    SELECT news_clusters.article_id, news_clusters.crawl_key
+    FROM news_clusters
+    LEFT JOIN sentiments ON sentiments.article_id = news_clusters.article_id
+    WHERE news_clusters.is_duplicate = 0 AND COALESCE(sentiments.source, 'page') = 'page'
+    """
+    if missing_only:
+        query += " AND sentiments.article_id IS NULL"
+    total = conn.execute(f"SELECT COUNT(*) FROM ({query})").fetchone()[0]
+    print(f"Re-scoring {total} articles from the article store", flush=True)
+
+    # The upsert goes through the sentiments triggers, so ticker_sentiment follows the new scores
+    upsert_query = f"""
+    INSERT INTO sentiments ({', '.join(SENTIMENT_COLUMNS)})
+    VALUES ({', '.join('?' * len(SENTIMENT_COLUMNS))})
+    ON CONFLICT (article_id) DO UPDATE SET
+        {', '.join(f"{column} = excluded.{column}" for column in SENTIMENT_COLUMNS[2:])}
+    """
+
+    scored = 0
+    missing = 0
+    rows = conn.execute(query)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(default_store_path(db_path),),
+    ) as pool:
+        while True:
+            batch = rows.fetchmany(BATCH_SIZE)
+            if not batch:
+                break
+
+            updates = []
+            urls = [url for _, url in batch]
+            for (article_id, url), scores in zip(batch, pool.map(rescore_article, urls, chunksize=32)):
+                if scores is None:
+                    missing += 1
+                    continue
+                updates.append((
+                    article_id,
+                    url,
+                    scores["neg"],
+                    scores["neu"],
+                    scores["pos"],
+                    scores["compound"],
+                    scores["overall_sentiment"],
+                ))
+
+            with conn:
+                conn.executemany(upsert_query, updates)
+            scored += len(updates)
+            print(f"Re-scored {scored}/{total} articles ({missing} not in the store)", flush=True)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-scores article sentiment from the local article store")
+    parser.add_argument("--missing-only", action="store_true", help="Only score articles without a sentiments row")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: every core)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    rescore("../" + os.getenv("DB_PATH"), missing_only=args.missing_only, workers=args.workers)
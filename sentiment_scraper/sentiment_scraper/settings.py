@@ -50,9 +50,22 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    "sentiment_scraper.middlewares.SentimentScraperDownloaderMiddleware": 543,
-#}
+# DomainHealthMiddleware runs before RobotsTxtMiddleware, so dead domains don't even get their robots.txt fetched
+DOWNLOADER_MIDDLEWARES = {
+    "sentiment_scraper.middlewares.DomainHealthMiddleware": 50,
+}
+
+# Upper bounds of the per-domain download timeout and response size set by DomainHealthMiddleware
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_MAXSIZE = 8 * 1024 * 1024
+
+# Domains whose pages yield article text less than DOMAIN_MIN_YIELD of the time (over at least DOMAIN_MIN_REQUESTS
+# requests) are skipped, except for one probe request every DOMAIN_PROBE_HOURS
+DOMAIN_MIN_REQUESTS = 5
+DOMAIN_MIN_YIELD = 0.2
+DOMAIN_PROBE_HOURS = 72
+# Extracted text shorter than this counts as a failed extraction (paywall, consent page, ...)
+DOMAIN_MIN_TEXT_CHARS = 200
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
@@ -62,9 +75,30 @@ ROBOTSTXT_OBEY = True
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    "sentiment_scraper.pipelines.SentimentScraperPipeline": 300,
-#}
+ITEM_PIPELINES = {
+    "sentiment_scraper.pipelines.ArticleAnalysisPipeline": 200,
+    "sentiment_scraper.pipelines.SentimentScraperPipeline": 300,
+}
+
+# Number of processes extracting and scoring articles (0 uses every core)
+ANALYSIS_WORKERS = 0
+
+# Sentiment rows are written in group commits of this many rows, or after this many seconds
+SENTIMENT_BATCH_SIZE = 100
+SENTIMENT_FLUSH_SECONDS = 5.0
+
+# Score the Finnhub summaries first, and only scrape the pages of articles whose summary is missing, shorter than
+# SUMMARY_MIN_CHARS or neutral. Set to False to scrape every article.
+SCORE_SUMMARIES_FIRST = True
+SUMMARY_MIN_CHARS = 80
+
+# Number of pages claimed from the crawl frontier at a time, and how many times a page is tried before it is given up on
+FRONTIER_PAGE_SIZE = 16
+FRONTIER_MAX_ATTEMPTS = 3
+# How long a claimed page stays leased to its worker without being renewed, before other workers may claim it
+FRONTIER_LEASE_SECONDS = 300
+# How often a spider following a frontier that is still being fed checks it for new pages
+FRONTIER_POLL_SECONDS = 1.0
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -1,105 +1,178 @@
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import TextResponse
+import socket
+from functools import partial
 import sqlite3
-from newspaper import Article
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
 from dotenv import load_dotenv
 import os
+from twisted.internet import task
+from db_schema import create_news_clusters_table, create_news_table
+from news_dedupe import NewsClusterer
+from sentiment_scraper.frontier import CrawlFrontier, queue_unanalyzed
+from sentiment_scraper.items import ArticleItem
 
 class DBSpider(scrapy.Spider):
     name = 'db_spider'
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, worker_id=None, prepare="yes", db_path=None, progress=None, upstream_done=None, *args, **kwargs):
+        """
+        Run with `-a worker_id=<id>` to crawl as one of several workers sharing the frontier (see `crawl_workers`).
+        `prepare` is whether to bring the frontier up to date first: `yes`, `no` (another process did it) or `only`.
+        A worker restarting under the same id takes back the pages it was crawling when it died.
+        When run in-process (see `pipeline.scrape_sentiment`), progress messages go to `progress` instead of stdout,
+        and the spider can follow a frontier that is still being fed: it then stays open, claiming new pages as they
+        are queued, until the `upstream_done` event is set.
+        """
         super().__init__(*args, **kwargs)
         load_dotenv()
-        self.db_path = "../" + os.getenv("DB_PATH")
+        self.db_path = db_path or "../" + os.getenv("DB_PATH")
+        self.progress = progress or partial(print, flush=True)
+        self.worker_id = worker_id or socket.gethostname()
+        self.prepare = prepare
+        self.upstream_done = upstream_done
+        self.conn = None
+        self.frontier = None
+        self.lease_loop = None
+        self.follow_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.idle, signal=signals.spider_idle)
+        return spider
 
     def start_requests(self):
-        # Connect to the database
-        print(self.db_path)
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Connect to the database, waiting on the other workers' writes rather than failing
+        self.progress(self.db_path)
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        self.conn = conn
 
-        cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS sentiments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            article_id INTEGER,
-            url TEXT,
-            score_neg REAL,
-            score_neu REAL,
-            score_pos REAL,
-            score_compound REAL,
-            overall_sentiment TEXT,
-            FOREIGN KEY (article_id) REFERENCES news(id),
-            UNIQUE (article_id)
-        )
-        """
+        # WAL lets the pipeline's sentiment inserts commit alongside the frontier updates made here
+        conn.execute("PRAGMA journal_mode=WAL")
+
+        self.frontier = CrawlFrontier(
+            conn,
+            self.worker_id,
+            self.settings.getfloat("FRONTIER_LEASE_SECONDS"),
+            self.settings.getint("FRONTIER_MAX_ATTEMPTS"),
         )
-        conn.commit()
+        if self.prepare != "no":
+            self.prepare_frontier(conn)
+        if self.prepare == "only":
+            return
 
-        # Fetch article URLs from the `news` table
-        cursor.execute("SELECT id, url FROM news")
-        rows = cursor.fetchall()
+        # Take back our own pages from a run that died, and keep the leases of the pages being crawled alive
+        self.frontier.release_own()
+        self.lease_loop = task.LoopingCall(self.frontier.renew)
+        self.lease_loop.start(self.frontier.lease_seconds / 3, now=False)
 
-        conn.close()
+        # Poll for newly queued pages, rather than only when the spider runs dry
+        if self.upstream_done is not None:
+            self.follow_loop = task.LoopingCall(self.follow)
+            self.follow_loop.start(self.settings.getfloat("FRONTIER_POLL_SECONDS"), now=False)
 
-        # Pass article_id along with the request
+        total = self.frontier.pending_pages()
+        self.progress(f"Found {total} pages that have not been analyzed yet")
+
+        # Pages are claimed one batch at a time as Scrapy asks for more requests, so memory stays flat however many
+        # articles are pending, and the work spreads evenly over however many workers there are
         count = 1
-        for row in rows:
-            print(f"Processing article {count}/{len(rows)} ({count/len(rows)*100:.2f}%)", flush=True)
-            count += 1
-            row_id = row[0]
-            url = row[1]
-            yield scrapy.Request(
-                url=url, 
-                callback=self.parse,
-                cb_kwargs={'article_id': row_id}
-            )
-
-    def parse(self, response, article_id):
-        # Connect to the database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Check if the article has already been analyzed
-        cursor.execute("SELECT article_id FROM sentiments WHERE article_id = ?", (article_id,))
-        result = cursor.fetchone()  # Fetch the first result, if any
-
-        if result:
-            # If the article is already in the database, skip further processing
-            self.logger.info(f"Article ID {article_id} has already been analyzed. Skipping...")
-            conn.close()
+        claim_size = self.settings.getint("FRONTIER_PAGE_SIZE")
+        while True:
+            pages = self.frontier.claim(claim_size)
+            if not pages:
+                break
+
+            for url, article_ids in pages:
+                if count <= total:
+                    self.progress(f"Processing article {count}/{total} ({count/total*100:.2f}%)")
+                else:
+                    # Pages were queued since the crawl started (e.g. while following the news stage), so there's no
+                    # total to report against
+                    self.progress(f"Processing article {count}")
+                count += 1
+                yield self.page_request(url, article_ids)
+
+    def page_request(self, crawl_key, article_ids):
+        # The frontier already hands every page out once, so a page claimed again (after its lease ran out) must not
+        # be dropped by the duplicate filter.
+        # The crawl key goes along as is, since Scrapy may re-encode the URL it requests.
+        return scrapy.Request(
+            url=crawl_key,
+            callback=self.parse,
+            errback=self.failed,
+            cb_kwargs={'article_ids': article_ids, 'crawl_key': crawl_key},
+            dont_filter=True,
+        )
+
+    def follow(self):
+        """
+        Claims the pages queued in the meantime, if the downloader has room for them. Returns how many were claimed.
+        """
+        if len(self.crawler.engine.downloader.active) >= self.settings.getint("CONCURRENT_REQUESTS"):
+            return 0
+
+        pages = self.frontier.claim(self.settings.getint("FRONTIER_PAGE_SIZE"))
+        if pages:
+            self.progress(f"Claimed {len(pages)} newly queued pages")
+        for url, article_ids in pages:
+            self.crawler.engine.crawl(self.page_request(url, article_ids))
+        return len(pages)
+
+    def idle(self):
+        """
+        While the frontier is still being fed, keeps the spider open
+        """
+        if self.upstream_done is None or self.frontier is None:
             return
 
-        # Extract main content using newspaper3k
-        article = Article(response.url)
-        article.set_html(response.text)
-        article.parse()
-        full_text = article.text
-
-        # Sentiment analysis
-        sid = SentimentIntensityAnalyzer()
-        scores = sid.polarity_scores(full_text)
-        overall_sentiment = self.interpret_sentiment(scores['compound'])
-
-        try:
-            cursor.execute(
-                """
-                INSERT OR IGNORE INTO sentiments (article_id, url, score_neg, score_neu, score_pos, score_compound, overall_sentiment)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
-                (article_id, response.url, scores['neg'], scores['neu'], scores['pos'], scores['compound'], overall_sentiment)
-            )
-            conn.commit()
-        except sqlite3.IntegrityError:
-            self.logger.warning(f"Article ID {article_id} already exists in sediments.")
-        finally:
-            conn.close()
-
-    def interpret_sentiment(self, compound_score):
-        if compound_score >= 0.05:
-            return "positive"
-        elif compound_score <= -0.05:
-            return "negative"
+        # Checked before claiming, so pages queued right before the upstream stage finished aren't missed
+        finished = self.upstream_done.is_set()
+        if self.follow() or not finished:
+            raise DontCloseSpider
+
+    def prepare_frontier(self, conn):
+        """
+        Analyzes whatever can be analyzed without crawling, then queues the rest in the crawl frontier
+        """
+        # Make sure every article has its canonical URL and belongs to a cluster of near-duplicate stories
+        create_news_table(conn)
+        create_news_clusters_table(conn)
+        NewsClusterer(conn).cluster_pending()
+
+        summary_min_chars = self.settings.getint("SUMMARY_MIN_CHARS") if self.settings.getbool("SCORE_SUMMARIES_FIRST") else None
+        queue_unanalyzed(conn, self.frontier, summary_min_chars, self.progress)
+
+    def failed(self, failure):
+        """
+        Records a failed request in the frontier. Pages on skipped domains go back to the queue without using up an attempt.
+        """
+        request = failure.request
+        article_ids = request.cb_kwargs['article_ids']
+        if request.meta.get("domain_skipped"):
+            self.frontier.skip(article_ids)
         else:
-            return "neutral"
+            self.logger.warning(f"Failed to fetch {request.url}: {failure.value!r}")
+            self.frontier.fail(article_ids, repr(failure.value))
+
+    def closed(self, reason):
+        for loop in (self.lease_loop, self.follow_loop):
+            if loop is not None and loop.running:
+                loop.stop()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def parse(self, response, article_ids, crawl_key):
+        # Pages that aren't text (PDFs, images, ...) can't be analyzed, so they use up an attempt like any failure
+        if not isinstance(response, TextResponse):
+            content_type = response.headers.get("Content-Type", b"").decode("latin-1")
+            self.logger.warning(f"Skipping {response.url}: not a text page ({content_type or 'no content type'})")
+            self.frontier.fail(article_ids, f"Not a text response ({content_type or 'no content type'})")
+            return
+
+        # The page is analyzed by ArticleAnalysisPipeline, then written to the database by SentimentScraperPipeline
+        # The stored text is keyed by the crawl key the page was claimed under, which rescoring looks it up by
+        yield ArticleItem(article_ids=article_ids, url=response.url, html=response.text, store_key=crawl_key)
@@ -3,143 +3,259 @@ from dotenv import load_dotenv
 import yfinance as yf
 import sys
 import sqlite3
+import numpy as np
 import pandas as pd
-from scipy.stats import zscore
+from fetch_engine import fetch_concurrently
+from fundamentals_cache import load_cached_info, store_info
 
 load_dotenv()
 
 # SQLite configuration
 SQLITE_DATABASE_PATH = os.getenv("DB_PATH")
 
-if not os.path.exists(SQLITE_DATABASE_PATH):
-    print(f"Error: SQLite file not found at {SQLITE_DATABASE_PATH}")
-    sys.exit(1)
+#Focus on small/mid-cap tech stocks
+MARKET_CAP_THRESHOLD = int(os.getenv("MARKET_CAP_THRESHOLD"))
 
-# Connect to your SQLite database file.
-conn = sqlite3.connect(SQLITE_DATABASE_PATH)
+# Concurrency and rate limiting of the fundamentals fetcher
+FETCH_MAX_IN_FLIGHT = int(os.getenv("FETCH_MAX_IN_FLIGHT", "8"))
+FETCH_RATE_PER_SECOND = float(os.getenv("FETCH_RATE_PER_SECOND", "5"))
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "3"))
+FETCH_BACKOFF_SECONDS = float(os.getenv("FETCH_BACKOFF_SECONDS", "1.0"))
 
-# Get a cursor object
-cur = conn.cursor()
+# Define risk-free rate (e.g., U.S. 10-year Treasury bond yield, assumed as 3%)
+RISK_FREE_RATE = float(os.getenv("RISK_FREE_RATE", "0.03"))
 
-#Focus on small/mid-cap tech stocks
-MARKET_CAP_THRESHOLD = int(os.getenv("MARKET_CAP_THRESHOLD"))
-cur.execute(f"SELECT symbol FROM tech_stocks WHERE market_cap >= {MARKET_CAP_THRESHOLD}")
+# Define expected market return (e.g., S&P 500 average return, assumed as 8%)
+MARKET_RETURN = float(os.getenv("MARKET_RETURN", "0.08"))
 
-# Fetch all results
-results = cur.fetchall()
+# Raw fundamentals taken from the yfinance `.info` blob, as (column, info key)
+FUNDAMENTAL_FIELDS = [
+    ("current_eps", "trailingEps"),
+    ("projected_eps", "forwardEps"),  # Forecasted EPS
+    ("stock_pe_ratio_forward", "forwardPE"),
+    ("stock_pe_ratio_trailing", "trailingPE"),
+    ("earnings_growth", "earningsGrowth"),
+    ("dividend_yield", "dividendYield"),
+    ("beta", "beta"),
+    ("current_price", "currentPrice"),
+]
 
-tickers = [item[0] for item in results]
-# print(tickers)
 
-print(f"Found {len(tickers)} tech stocks with market cap greater than or equal to {MARKET_CAP_THRESHOLD}")
+def fetch_info(ticker):
+    return yf.Ticker(ticker).info
 
-# Define risk-free rate (e.g., U.S. 10-year Treasury bond yield, assumed as 3%)
-risk_free_rate = .03
 
-# Define expected market return (e.g., S&P 500 average return, assumed as 8%)
-market_return = 0.08
-
-def fetch_stock_data(tickers, risk_free_rate, market_return):
-    count = 1
-    data = {}
-    FORWARD_WEIGHT = .4 #less because the projection might be inaccurate
-    TRAILING_WEIGHT = .6
-    for ticker in tickers:
-        print(f"\rProcessing {ticker} ({count}/{len(tickers)})", end="")
-        count = count + 1
-        try:
-            stock = yf.Ticker(ticker)
-            earnings_growth = (stock.info.get("earningsGrowth", None) or 0.0)
-            dividend_yield = stock.info.get("dividendYield", None) or 0.0
-            current_eps = stock.info.get("trailingEps", 0.0)
-            projected_eps = stock.info.get("forwardEps", 0.0)  # Forecasted EPS
-            stock_pe_ratio_forward = stock.info.get("forwardPE", 0.0)
-            stock_pe_ratio_trailing = stock.info.get("trailingPE", 0.0)
-            beta = stock.info.get("beta", 1.0)
-            curr_price = stock.info.get("currentPrice", 0.0)
-            
-            # combined_stock_pe = (stock_pe_ratio_trailing * TRAILING_WEIGHT) + (stock_pe_ratio_forward * FORWARD_WEIGHT)
-            if projected_eps and stock_pe_ratio_forward and curr_price and earnings_growth:
-                discount_rate = risk_free_rate + (beta * (market_return - risk_free_rate))
-                intrinsic_value = projected_eps * stock_pe_ratio_forward * (1 + earnings_growth) * (1 - discount_rate)
-                fair_value = projected_eps * (1 + earnings_growth) * stock_pe_ratio_forward
-                valuation_gap = ((curr_price - intrinsic_value) / intrinsic_value) * 100
-            
-            data[ticker] = {
-                'current_eps': current_eps,
-                'projected_eps': projected_eps,
-                'stock_pe_ratio_forward': stock_pe_ratio_forward,
-                'stock_pe_ratio_trailing': stock_pe_ratio_trailing,
-                'earnings_growth': earnings_growth,
-                'dividend_yield': dividend_yield,
-                'beta': beta,
-                'current_price': curr_price,
-                'intrinsic_value': intrinsic_value,
-                'fair_value': fair_value,
-                'valuation_gap': valuation_gap,
-                'valuation': "overvalued" if valuation_gap > 0 else "undervalued",
-            }
-            
-        except ValueError as e:
-            print(f"Error {e}")
+def extract_fundamentals(info):
+    """
+    Picks the raw fundamentals out of a yfinance `.info` blob. Missing fields are left as `None`.
+    """
+    return {column: info.get(key) for column, key in FUNDAMENTAL_FIELDS}
+
+
+def fundamentals_frame(infos):
+    """
+    Builds the DataFrame of raw fundamentals from yfinance `.info` blobs keyed by symbol
+    """
+    rows = {ticker: extract_fundamentals(info) for ticker, info in infos.items()}
+    columns = [column for column, _ in FUNDAMENTAL_FIELDS]
+    fundamentals = pd.DataFrame.from_dict(rows, orient="index", columns=columns)
+    return fundamentals.apply(pd.to_numeric, errors="coerce").replace([np.inf, -np.inf], np.nan)
+
+
+def fetch_fundamentals(tickers, conn, progress=print, on_fetched=None):
+    """
+    Fetches the raw fundamentals of every ticker into a DataFrame indexed by symbol, one column per field.
+    Fresh payloads are read from the fundamentals cache, and only the rest are fetched (and cached).
+    Tickers that could not be fetched are left out.
+    `on_fetched(ticker, info)` is called for every ticker as soon as its fundamentals are known.
+    """
+    infos = load_cached_info(conn, tickers)
+    stale = [ticker for ticker in tickers if ticker not in infos]
+    progress(f"Using cached fundamentals for {len(infos)} tickers, fetching {len(stale)}")
+    if on_fetched is not None:
+        for ticker, info in infos.items():
+            on_fetched(ticker, info)
+
+    fetched = {}
+    results = fetch_concurrently(
+        stale,
+        fetch_info,
+        max_in_flight=FETCH_MAX_IN_FLIGHT,
+        rate_per_second=FETCH_RATE_PER_SECOND,
+        retries=FETCH_RETRIES,
+        backoff=FETCH_BACKOFF_SECONDS,
+        progress=progress,
+    )
+    for ticker, info, error in results:
+        if error is not None:
+            progress(f"Error {ticker}: {error}")
             continue
+        fetched[ticker] = info
+        if on_fetched is not None:
+            on_fetched(ticker, info)
+
+    store_info(conn, fetched)
+    infos.update(fetched)
+    return fundamentals_frame(infos)
+
+
+def compute_valuation(fundamentals, risk_free_rate, market_return):
+    """
+    Computes the intrinsic value, fair value, valuation gap and valuation of every stock in one vectorized pass.
+    Stocks missing any of the required inputs get NaN values (and no valuation) instead of being silently skipped.
+    """
+    data = fundamentals.copy()
+    data["dividend_yield"] = data["dividend_yield"].fillna(0.0)
+    data["beta"] = data["beta"].fillna(1.0)
+
+    # Only value stocks with a projected EPS, forward PE, price and earnings growth
+    required = data[["projected_eps", "stock_pe_ratio_forward", "current_price", "earnings_growth"]]
+    valuable = required.notna().all(axis=1) & required.ne(0).all(axis=1)
+
+    discount_rate = risk_free_rate + (data["beta"] * (market_return - risk_free_rate))
+    fair_value = (data["projected_eps"] * (1 + data["earnings_growth"]) * data["stock_pe_ratio_forward"]).where(valuable)
+    intrinsic_value = fair_value * (1 - discount_rate)
+    valuation_gap = ((data["current_price"] - intrinsic_value) / intrinsic_value.replace(0, np.nan)) * 100
+
+    data["intrinsic_value"] = intrinsic_value
+    data["fair_value"] = fair_value
+    data["valuation_gap"] = valuation_gap
+    data["valuation"] = np.where(valuation_gap > 0, "overvalued", "undervalued")
+    data.loc[valuation_gap.isna(), "valuation"] = None
     return data
 
-stock_data = fetch_stock_data(tickers, risk_free_rate, market_return)
-    
-# Convert to DataFrame
-data = pd.DataFrame.from_dict(stock_data, orient="index")
 
-#Cleaning Data
+def intrinsic_ratio(data):
+    return data["intrinsic_value"] / data["current_price"].replace(0, np.nan)
+
+
+def fundamentals_mask(data):
+    # 1. Remove rows with negative or zero EPS values
+    # 2. Verify PE ratios
+    # 3. Verify Earnings Growth
+    return (data["projected_eps"] > 0) & (data["stock_pe_ratio_forward"] > 0) & (data["earnings_growth"] >= 0)
+
 
-# 1. Remove rows with negative or zero EPS values
-data = data[(data['projected_eps'] > 0)]
+def sanity_mask(data):
+    # 5. Verify Intrinsic Value Ratio
+    mask = intrinsic_ratio(data) < 3
 
-# 2. Verify PE ratios
-data = data[(data['stock_pe_ratio_forward']) > 0]
+    # 6. Drop Missing or 0 values (comparisons with NaN are False)
+    mask &= (data["current_price"] > 0) & (data["intrinsic_value"] > 0) & (data["fair_value"] > 0)
+    return mask
 
-# 3. Verify Earnings Growth
-data = data[(data['earnings_growth']) >= 0]
 
-# 4. Use Z-Score for outlier detection 
-data['intrinsic_ratio'] = data['intrinsic_value'] / data['current_price']
-data['z_score_intrinsic'] = zscore(data['intrinsic_ratio'])
-data = data[(abs(data['z_score_intrinsic']) < 2)]
+def clean_valuation(data):
+    """
+    Applies the data cleaning rules as a single boolean mask, returning the stocks that pass all of them
+    """
+    mask = fundamentals_mask(data)
+
+    # 4. Use Z-Score for outlier detection, over the stocks passing the rules above (NaN ratios are ignored)
+    ratio = intrinsic_ratio(data)
+    population = ratio[mask]
+    z_score_intrinsic = (ratio - population.mean()) / population.std(ddof=0)
+    mask &= z_score_intrinsic.abs() < 2
+
+    mask &= sanity_mask(data)
+    return data[mask]
+
+
+def provisional_valuation(ticker, info, risk_free_rate=RISK_FREE_RATE, market_return=MARKET_RETURN):
+    """
+    Values a single stock as soon as its fundamentals arrive, returning its valuation or `None` if it would be
+    cleaned out. Every rule but the z-score (which needs the whole population) is applied, so the final set of
+    undervalued stocks is a subset of the provisionally undervalued ones.
+    """
+    data = compute_valuation(fundamentals_frame({ticker: info}), risk_free_rate, market_return)
+    if not (fundamentals_mask(data) & sanity_mask(data)).iloc[0]:
+        return None
+    return data["valuation"].iloc[0]
+
+
+def value_stocks(fundamentals, risk_free_rate=RISK_FREE_RATE, market_return=MARKET_RETURN):
+    """
+    Values and cleans the fetched fundamentals. Can be rerun with different rates without refetching anything.
+    """
+    return clean_valuation(compute_valuation(fundamentals, risk_free_rate, market_return))
+
+
+def write_valuations(conn, data):
+    """
+    Writes the valued stocks back to `tech_stocks` and removes the rest, as set operations in a single transaction.
+    The rows are staged into a temp table with `executemany`, so the number of round-trips (and bound parameters
+    per statement) stays constant no matter how many stocks there are.
+    """
+    columns = list(data.columns)
+
+    with conn:
+        conn.execute("DROP TABLE IF EXISTS temp.valuation_staging")
+        conn.execute(f"CREATE TEMP TABLE valuation_staging (symbol TEXT PRIMARY KEY, {', '.join(columns)})")
+        conn.executemany(
+            f"INSERT INTO valuation_staging (symbol, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})",
+            data.astype(object).where(data.notna(), None).itertuples(name=None),
+        )
 
-# 5. Verify Intrinsic Value Ratiox
-data = data[(data['intrinsic_ratio'] < 3)]
-data = data.drop(columns=["intrinsic_ratio", "z_score_intrinsic"])
+        # Update rows with the staged data
+        conn.execute(f"""
+        UPDATE tech_stocks
+        SET {', '.join([f"{column} = valuation_staging.{column}" for column in columns])}
+        FROM valuation_staging
+        WHERE tech_stocks.symbol = valuation_staging.symbol
+        """)
 
-# 6. Drop Missing or 0 values
-data = data.dropna(subset=["current_price", "intrinsic_value", "fair_value"])
-data = data[(data['current_price'] > 0) & 
-            (data['intrinsic_value'] > 0) & 
-            (data['fair_value'] > 0)]
-print(f"\nFiltered down to {len(data)} stocks after data cleaning.")
+        # Remove rows that were filtered out
+        conn.execute("""
+        DELETE FROM tech_stocks
+        WHERE symbol NOT IN (SELECT symbol FROM valuation_staging)
+        """)
 
+        conn.execute("DROP TABLE temp.valuation_staging")
 
-# Update rows with JSON data
-for index, row in data.iterrows():
-    # Prepare the update query
-    update_query = f"""
-    UPDATE tech_stocks
-    SET {', '.join([f"{key} = ?" for key in data.columns])}
-    WHERE symbol = ?
+
+def run_valuation(conn, progress=print, on_undervalued=None):
+    """
+    Values every stock above the market cap threshold and writes the result back to `tech_stocks`,
+    returning the valued stocks. `on_undervalued(ticker)` is called as soon as a stock is provisionally undervalued
+    (see `provisional_valuation`), long before the whole valuation is done.
     """
-    update_values = tuple(row.values) + (index,)
-    cur.execute(update_query, update_values)
+    # Get a cursor object
+    cur = conn.cursor()
+
+    cur.execute("SELECT symbol FROM tech_stocks WHERE market_cap >= ?", (MARKET_CAP_THRESHOLD,))
+
+    # Fetch all results
+    results = cur.fetchall()
+
+    tickers = [item[0] for item in results]
+
+    progress(f"Found {len(tickers)} tech stocks with market cap greater than or equal to {MARKET_CAP_THRESHOLD}")
+
+    def on_fetched(ticker, info):
+        if provisional_valuation(ticker, info) == "undervalued":
+            on_undervalued(ticker)
+
+    fundamentals = fetch_fundamentals(tickers, conn, progress, on_fetched if on_undervalued is not None else None)
+    data = value_stocks(fundamentals)
+    progress(f"Filtered down to {len(data)} stocks after data cleaning.")
+
+    write_valuations(conn, data)
+    return data
+
+
+def main():
+    if not os.path.exists(SQLITE_DATABASE_PATH):
+        print(f"Error: SQLite file not found at {SQLITE_DATABASE_PATH}")
+        sys.exit(1)
+
+    # Connect to your SQLite database file.
+    conn = sqlite3.connect(SQLITE_DATABASE_PATH)
 
-# Remove rows not in the JSON file (optional)
-symbols = tuple(data.index)
-delete_query = ("""
-DELETE FROM tech_stocks
-WHERE symbol NOT IN ({})
-""".format(','.join('?' * len(symbols))))
-cur.execute(delete_query, symbols)
+    run_valuation(conn)
 
-# # Commit changes
-conn.commit()
+    # Close the connection
+    conn.close()
 
-# Close the connection
-conn.close()
 
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import sys
 import json
 from dotenv import load_dotenv
 from collections import Counter
+from db_schema import create_tech_stocks_table
 
 # Load environment variables
 load_dotenv()
@@ -17,88 +18,92 @@ SECTOR = os.getenv("SECTOR")
 
 # SQLite configuration
 SQLITE_DATABASE_PATH = os.getenv("DB_PATH")
-if not os.path.exists(SQLITE_DATABASE_PATH):
-    print(f"Error: SQLite file not found at {SQLITE_DATABASE_PATH}")
-    sys.exit(1)
-
-# Fetch data from API
-data = []
-url = URL
-response = requests.get(url)
-response_data = response.json().get("data", {}).get("data", [])
-data.extend(response_data)
-
-print(f"Total stocks fetched: {len(data)}")
-
-# Count occurrences of symbols to detect duplicates, in case there are any
-symbol_counts = Counter(stock.get("s") for stock in data if stock.get("s"))
-duplicates = {symbol: count for symbol, count in symbol_counts.items() if count > 1}
-
-# Log duplicates, in case there are any
-if duplicates:
-    print(f"Found {len(duplicates)} duplicate symbols:")
-    for symbol, count in duplicates.items():
-        print(f"  {symbol}: {count} occurrences")
-
-# Filter for technology sector and deduplicate by 'symbol'
-tech_stocks = [stock for stock in data if stock.get("sector") is not None and stock.get("sector").lower()  == SECTOR.lower()]
-unique_stocks = {stock["s"]: stock for stock in tech_stocks if stock.get("s")}.values()
-print(f"Found {len(tech_stocks)} {SECTOR} stocks")
-
-# Connect to SQLite database
-conn = sqlite3.connect(SQLITE_DATABASE_PATH)
-cur = conn.cursor()
-
-# Create the tech_stocks table
-cur.execute("""
-CREATE TABLE IF NOT EXISTS tech_stocks (
-    symbol TEXT PRIMARY KEY,
-    name TEXT,
-    market_cap REAL,
-    sector TEXT, 
-    current_eps REAL,
-    projected_eps REAL,
-    stock_pe_ratio_forward REAL,
-    stock_pe_ratio_trailing REAL,
-    earnings_growth REAL,
-    dividend_yield REAL,
-    beta REAL,
-    current_price REAL,
-    intrinsic_value REAL,
-    fair_value REAL,
-    valuation_gap REAL,
-    valuation TEXT
-);
-""")
-
-# Insert stocks into the database
-inserted_count = 0
-skipped_stocks = []
-for stock in unique_stocks:
-    try:
-        cur.execute("""
-        INSERT OR REPLACE INTO tech_stocks (
-            symbol, name, market_cap, sector
-        ) VALUES (?, ?, ?, ?);
-        """, (
-            stock.get("s"),
-            stock.get("n"),
-            stock.get("marketCap"),
-            stock.get("sector"),
-        ))
-        inserted_count += 1
-    except sqlite3.Error as e:
-        print(f"Error inserting stock {stock.get('s')}: {e}")
-        skipped_stocks.append(stock.get("s"))
-
-# Commit and close the connection
-conn.commit()
-cur.execute("SELECT COUNT(*) FROM tech_stocks;")
-row_count = cur.fetchone()[0]
-conn.close()
-
-# Final output
-print(f"Data inserted: {inserted_count} stocks successfully into tech_stocks table.")
-print(f"Number of records in the database: {row_count}")
-if skipped_stocks:
-    print(f"Skipped {len(skipped_stocks)} stocks: {skipped_stocks}")
+
+
+def fetch_screener():
+    """
+    Fetches every stock of the exchange from the screener
+    """
+    response = requests.get(URL)
+    return response.json().get("data", {}).get("data", [])
+
+
+def filter_sector(data, sector, progress=print):
+    """
+    Returns the stocks of the sector, deduplicated by symbol
+    """
+    # Count occurrences of symbols to detect duplicates, in case there are any
+    symbol_counts = Counter(stock.get("s") for stock in data if stock.get("s"))
+    duplicates = {symbol: count for symbol, count in symbol_counts.items() if count > 1}
+
+    # Log duplicates, in case there are any
+    if duplicates:
+        progress(f"Found {len(duplicates)} duplicate symbols:")
+        for symbol, count in duplicates.items():
+            progress(f"  {symbol}: {count} occurrences")
+
+    # Filter for technology sector and deduplicate by 'symbol'
+    tech_stocks = [stock for stock in data if stock.get("sector") is not None and stock.get("sector").lower()  == sector.lower()]
+    unique_stocks = list({stock["s"]: stock for stock in tech_stocks if stock.get("s")}.values())
+    progress(f"Found {len(tech_stocks)} {sector} stocks")
+    return unique_stocks
+
+
+def store_stocks(conn, stocks, progress=print):
+    """
+    Inserts the stocks into `tech_stocks`, returning how many were inserted
+    """
+    create_tech_stocks_table(conn)
+    cur = conn.cursor()
+
+    # Insert stocks into the database
+    inserted_count = 0
+    skipped_stocks = []
+    for stock in stocks:
+        try:
+            cur.execute("""
+            INSERT OR REPLACE INTO tech_stocks (
+                symbol, name, market_cap, sector
+            ) VALUES (?, ?, ?, ?);
+            """, (
+                stock.get("s"),
+                stock.get("n"),
+                stock.get("marketCap"),
+                stock.get("sector"),
+            ))
+            inserted_count += 1
+        except sqlite3.Error as e:
+            progress(f"Error inserting stock {stock.get('s')}: {e}")
+            skipped_stocks.append(stock.get("s"))
+
+    conn.commit()
+    cur.execute("SELECT COUNT(*) FROM tech_stocks;")
+    row_count = cur.fetchone()[0]
+
+    # Final output
+    progress(f"Data inserted: {inserted_count} stocks successfully into tech_stocks table.")
+    progress(f"Number of records in the database: {row_count}")
+    if skipped_stocks:
+        progress(f"Skipped {len(skipped_stocks)} stocks: {skipped_stocks}")
+    return inserted_count
+
+
+def main():
+    if not os.path.exists(SQLITE_DATABASE_PATH):
+        print(f"Error: SQLite file not found at {SQLITE_DATABASE_PATH}")
+        sys.exit(1)
+
+    # Fetch data from API
+    data = fetch_screener()
+    print(f"Total stocks fetched: {len(data)}")
+
+    stocks = filter_sector(data, SECTOR)
+
+    # Connect to SQLite database
+    conn = sqlite3.connect(SQLITE_DATABASE_PATH)
+    store_stocks(conn, stocks)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,68 +1,63 @@
+import glob
+import hashlib
 import sqlite3
+from datetime import datetime
 import pandas as pd
 import os
-import matplotlib.pyplot as plt
-import seaborn as sns
+import joblib
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import r2_score
 from dotenv import load_dotenv
+from db_schema import create_ranking_tables, create_ticker_sentiment_table
 
 load_dotenv()
 
+# Features used by the ranking model, and the target it is trained on
+FEATURES = ['valuation_gap', 'avg_compound_sentiment', 'market_cap']
+TARGET = 'future_return'
 
+# Directory where trained models are stored, one artifact per data fingerprint
+MODEL_CACHE_PATH = os.getenv("MODEL_CACHE_PATH", "./models/")
 
-def pick_top_Stock(n = int(os.getenv("TOP_N_STOCKS"))):
-    # Load environment variables
-    plot_path = os.getenv("PLOT_OUTPUT_PATH")
-    valuation = os.getenv("VALUATION")
 
-    if plot_path is None:
-        print("Error: Plot output path not found in environment variables.")
-        print("Please set PLOT_OUTPUT_PATH in your .env file.")
-        print("It should be a relative path to the directory where you want to save the plots, such as \"./plots/\".")
-        exit(1)
+def data_fingerprint(conn):
+    """
+    Hashes the contents of `tech_stocks` and the per-ticker sentiment aggregate that the model is trained on.
+    The fingerprint only changes when the underlying data does, so it is used as the key of the model artifact.
+    """
+    digest = hashlib.sha256()
+    digest.update(os.getenv("VALUATION", "").encode("utf-8"))
 
-    # Create the directory if it doesn't exist
-    if not os.path.exists(plot_path):
-        os.makedirs(plot_path)
+    for row in conn.execute("SELECT * FROM tech_stocks ORDER BY symbol;"):
+        digest.update(repr(row).encode("utf-8"))
 
-    # Delete all .png files in the directory
-    for file in os.listdir(plot_path):
-        if file.endswith(".png"):
-            os.remove(os.path.join(plot_path, file))
+    for row in conn.execute("SELECT ticker, score_sum, score_count FROM ticker_sentiment ORDER BY ticker;"):
+        digest.update(repr(row).encode("utf-8"))
 
+    return digest.hexdigest()[:16]
 
-    ############################################
-    # Load Data from Database
-    ############################################
-
-    # Connect to the SQLite database
-    db_path = os.getenv("DB_PATH")
-    conn = sqlite3.connect(db_path)
-
-    # Load tech_stocks that have valuation data
-    df_stocks = pd.read_sql_query(f"SELECT * FROM tech_stocks WHERE valuation == \"{valuation}\";", conn)
 
-    # Load news and sentiments, and join them
-    # We want to aggregate sentiment by ticker
-    df_news = pd.read_sql_query("SELECT * FROM news;", conn)
-    df_sentiments = pd.read_sql_query("SELECT * FROM sentiments;", conn)
+def load_ticker_sentiment(conn):
+    """
+    Loads the average compound sentiment of every ticker's articles from the `ticker_sentiment` aggregate
+    """
+    return pd.read_sql_query(
+        """
+        SELECT ticker, score_sum / score_count AS avg_compound_sentiment
+        FROM ticker_sentiment
+        WHERE score_count > 0;
+        """,
+        conn,
+    )
 
-    # Join sentiments with news on article_id = news.id
-    df_news_sent = pd.merge(df_news, df_sentiments, left_on='id', right_on='article_id', how='inner')
 
-    # Aggregate sentiment scores by ticker
-    # We'll use mean of score_compound as a simple aggregated sentiment measure
-    df_ticker_sentiment = df_news_sent.groupby('ticker', as_index=False).agg({
-        'score_compound': 'mean'
-    }).rename(columns={'score_compound': 'avg_compound_sentiment'})
-
-    conn.close()
-
-    ############################################
-    # Feature Engineering
-    ############################################
+def load_stocks_with_sentiment(conn, valuation):
+    """
+    Loads the tech_stocks with the given valuation, along with their average sentiment
+    """
+    df_stocks = pd.read_sql_query("SELECT * FROM tech_stocks WHERE valuation == ?;", conn, params=(valuation,))
+    df_ticker_sentiment = load_ticker_sentiment(conn)
 
     # Merge sentiment data with the stocks data
     df = pd.merge(df_stocks, df_ticker_sentiment, left_on='symbol', right_on='ticker', how='left')
@@ -70,28 +65,34 @@ def pick_top_Stock(n = int(os.getenv("TOP_N_STOCKS"))):
 
     # Replace NaN sentiment with 0 if no articles found
     df['avg_compound_sentiment'] = df['avg_compound_sentiment'].fillna(0)
+    return df
 
-    # Create target variable: future_return = (future_price - current_price) / current_price
-    df['future_return'] = (df['intrinsic_value'] - df['current_price']) / df['current_price']
 
-    # For modeling, let's pick some key features:
-    # We'll use valuation_gap, avg_compound_sentiment, market_cap, pe_ratio, revenue_growth as an example.
-    features = ['valuation_gap', 'avg_compound_sentiment', 'market_cap']
-    target = 'future_return'
+def train_model(conn, fingerprint=None):
+    """
+    Trains the ranking model on the current data and saves it to `MODEL_CACHE_PATH`, keyed by the data fingerprint.
+    Any artifacts from older data are removed.
+    """
+    if fingerprint is None:
+        fingerprint = data_fingerprint(conn)
 
-    # Filter rows where we have no future price or current price
-    df = df.dropna(subset=['future_return'] + features)
+    ############################################
+    # Feature Engineering
+    ############################################
+
+    df = load_stocks_with_sentiment(conn, os.getenv("VALUATION"))
 
-    # Correlation Matrix
-    corr_cols = features + [target]
-    corr = df[corr_cols].corr()
+    # Create target variable: future_return = (future_price - current_price) / current_price
+    df[TARGET] = (df['intrinsic_value'] - df['current_price']) / df['current_price']
 
+    # Filter rows where we have no future price or current price
+    df = df.dropna(subset=[TARGET] + FEATURES)
 
     ############################################
     # Modeling
     ############################################
-    X = df[features]
-    y = df[target]
+    X = df[FEATURES]
+    y = df[TARGET]
 
     # Train-test split
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
@@ -100,50 +101,179 @@ def pick_top_Stock(n = int(os.getenv("TOP_N_STOCKS"))):
     model = RandomForestRegressor(n_estimators=100, random_state=42)
     model.fit(X_train, y_train)
 
-    # Predict on test set
-    y_pred = model.predict(X_test)
-
-    # Evaluate
-    r2 = r2_score(y_test, y_pred)
-
-    # Plot Predicted vs Actual
-
-    # Draw a reference line y=x
-    mn = min(y_test.min(), y_pred.min())
-    mx = max(y_test.max(), y_pred.max())
-
-
-    # Feature Importance
-    importances = model.feature_importances_
-    imp_df = pd.DataFrame({'feature': features, 'importance': importances})
-    imp_df = imp_df.sort_values('importance', ascending=False)
-
-
-    # Connect to DB and get the latest stocks data
-    conn = sqlite3.connect(db_path)
-    df_latest = pd.read_sql_query("SELECT * FROM tech_stocks WHERE valuation == \"undervalued\";", conn)
-
-    # Also get latest sentiment data
-    df_news = pd.read_sql_query("SELECT * FROM news;", conn)
-    df_sents = pd.read_sql_query("SELECT * FROM sentiments;", conn)
-    conn.close()
-
-    df_ns = pd.merge(df_news, df_sents, left_on='id', right_on='article_id', how='inner')
-    df_latest_sent = df_ns.groupby('ticker', as_index=False).agg({'score_compound': 'mean'}).rename(columns={'score_compound': 'avg_compound_sentiment'})
-    df_latest = pd.merge(df_latest, df_latest_sent, left_on='symbol', right_on='ticker', how='left').drop('ticker', axis=1)
-    df_latest['avg_compound_sentiment'] = df_latest['avg_compound_sentiment'].fillna(0)
+    # Evaluate on test set
+    r2 = r2_score(y_test, model.predict(X_test))
+    print(f"Trained ranking model {fingerprint} on {len(X_train)} stocks (test R^2: {r2:.3f})")
+
+    # Save the new artifact and remove the stale ones. Several processes may be doing the same (e.g. the bot's
+    # executors), so the artifact is written under a temporary name and renamed into place, which is atomic.
+    os.makedirs(MODEL_CACHE_PATH, exist_ok=True)
+    model_path = os.path.join(MODEL_CACHE_PATH, f"model-{fingerprint}.joblib")
+    tmp_path = f"{model_path}.{os.getpid()}.tmp"
+    joblib.dump(model, tmp_path)
+    os.replace(tmp_path, model_path)
+    for stale_path in glob.glob(os.path.join(MODEL_CACHE_PATH, "model-*.joblib")):
+        if stale_path != model_path:
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+
+    return model
+
+
+def load_or_train_model(conn=None, fingerprint=None):
+    """
+    Returns the ranking model for the current data, loading the cached artifact if there is one and training it otherwise.
+    The artifact is memory-mapped, so loading it takes milliseconds.
+    """
+    close_conn = conn is None
+    if close_conn:
+        conn = sqlite3.connect(os.getenv("DB_PATH"))
+
+    try:
+        create_ticker_sentiment_table(conn)
+        if fingerprint is None:
+            fingerprint = data_fingerprint(conn)
+        model_path = os.path.join(MODEL_CACHE_PATH, f"model-{fingerprint}.joblib")
+        if os.path.exists(model_path):
+            return joblib.load(model_path, mmap_mode="r")
+        return train_model(conn, fingerprint)
+    finally:
+        if close_conn:
+            conn.close()
+
+
+def rank_stocks(conn):
+    """
+    Ranks the undervalued stocks by the return the model predicts for them, best first.
+    Returns the ranked stocks, with their features and predicted return, along with the model's data fingerprint.
+    """
+    create_ticker_sentiment_table(conn)
+    fingerprint = data_fingerprint(conn)
+    model = load_or_train_model(conn, fingerprint)
+    df_latest = load_stocks_with_sentiment(conn, "undervalued")
 
     # Prepare feature matrix
     # Note: We are predicting future_return, even though we may not have future_price yet. 
     # The idea is that the model gives us a predicted score, and we rank by it.
-    X_live = df_latest[features].fillna(0)  # Fill NaNs if any
+    X_live = df_latest[FEATURES].fillna(0)  # Fill NaNs if any
 
     df_latest['predicted_return'] = model.predict(X_live)
 
     # Sort by predicted return
-    df_top = df_latest.sort_values('predicted_return', ascending=False).head(n)
+    df_ranked = df_latest.sort_values('predicted_return', ascending=False)
+    return df_ranked, fingerprint
 
-    df_top.reset_index(drop=True, inplace=True)
-    df_top.index = df_top.index + 1 # Start at 1, not 0
 
+def top_frame(df_top):
+    """
+    Numbers the top stocks from 1 and keeps the columns that are shown
+    """
+    df_top = df_top.reset_index(drop=True)
+    df_top.index = df_top.index + 1 # Start at 1, not 0
     return df_top[['symbol', 'current_price']]
+
+
+def store_ranking(conn, df_ranked, fingerprint):
+    """
+    Stores a ranking as a new run in `ranking_runs` and `top_stocks`, returning the run id
+    """
+    create_ranking_tables(conn)
+    now = datetime.now()
+    rows = df_ranked[['symbol', 'current_price', 'predicted_return'] + FEATURES]
+    with conn:
+        run_id = conn.execute(
+            """
+            INSERT INTO ranking_runs (run_at, run_date, model_fingerprint, valuation, stocks)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (now.isoformat(timespec="seconds"), now.date().isoformat(), fingerprint, "undervalued", len(rows)),
+        ).lastrowid
+        conn.executemany(
+            f"""
+            INSERT INTO top_stocks (run_id, rank, symbol, current_price, predicted_return, {', '.join(FEATURES)})
+            VALUES ({', '.join('?' * (len(FEATURES) + 5))})
+            """,
+            [
+                (run_id, rank, *row)
+                for rank, row in enumerate(rows.astype(object).where(rows.notna(), None).itertuples(index=False), start=1)
+            ],
+        )
+    return run_id
+
+
+def load_ranking(conn, n=None, run_date=None):
+    """
+    Loads the top `n` stocks (all of them if `n` is None) of the latest stored run, or of the latest run on
+    `run_date` (a `YYYY-MM-DD` string). Returns None if there is no such run.
+    """
+    create_ranking_tables(conn)
+    run = conn.execute(
+        """
+        SELECT run_id FROM ranking_runs
+        WHERE ? IS NULL OR run_date = ?
+        ORDER BY run_id DESC
+        LIMIT 1
+        """,
+        (run_date, run_date),
+    ).fetchone()
+    if run is None:
+        return None
+
+    return pd.read_sql_query(
+        f"""
+        SELECT rank, symbol, current_price, predicted_return, {', '.join(FEATURES)}
+        FROM top_stocks
+        WHERE run_id = ?
+        ORDER BY rank
+        LIMIT ?
+        """,
+        conn,
+        params=(run[0], -1 if n is None else n),
+    )
+
+
+def run_ranking(n=int(os.getenv("TOP_N_STOCKS"))):
+    """
+    Ranks the stocks on the current data and stores the ranking as a new run, returning its top `n` stocks.
+    Run at the end of the nightly job, so that later requests only have to read the stored run.
+    """
+    conn = sqlite3.connect(os.getenv("DB_PATH"))
+    try:
+        df_ranked, fingerprint = rank_stocks(conn)
+        run_id = store_ranking(conn, df_ranked, fingerprint)
+        print(f"Stored ranking run {run_id} of {len(df_ranked)} stocks")
+    finally:
+        conn.close()
+    return top_frame(df_ranked.head(n))
+
+
+def stored_top_stocks(n=int(os.getenv("TOP_N_STOCKS"))):
+    """
+    Returns the top `n` stocks of the latest stored ranking, or None if there is none yet
+    """
+    conn = sqlite3.connect(os.getenv("DB_PATH"))
+    try:
+        df_top = load_ranking(conn, n)
+    finally:
+        conn.close()
+
+    if df_top is None:
+        return None
+    return top_frame(df_top)
+
+
+def latest_top_stocks(n=int(os.getenv("TOP_N_STOCKS"))):
+    """
+    Returns the top `n` stocks of the latest stored ranking, ranking the stocks now if there is none yet
+    """
+    df_top = stored_top_stocks(n)
+    if df_top is None:
+        return run_ranking(n)
+    return df_top
+
+
+if __name__ == "__main__":
+    # Train (or reuse) the model for the current data and store the ranking, as done at the end of the nightly run
+    run_ranking()